@@ -1,301 +1,770 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from ctypes import *
 from contextlib import asynccontextmanager
+from concurrent.futures import Future
+from functools import lru_cache
+import asyncio
+import itertools
+import json
+import math
+import os
+import queue
+import threading
+import time
+import traceback
+
+import history
+import masterbus
+import metrics
+import packed
+from scheduling import next_deadline
+from masterbus import libmasterbus, MasterBusError
 
-# --- Type Definitions and Structures ---
-
-# Load the shared library
 try:
-    libmasterbus = CDLL("/usr/local/lib/libmasterbus.so")
-except OSError as e:
-    print("Fatal: Could not load libmasterbus.so from /usr/local/lib or current directory.")
-    raise e
-
-class MasterBusAPIContext(Structure): pass
-class MasterBusValue(Structure): pass
-
-class MasterBusDate(Structure):
-    _fields_ = [("day", c_int), ("mon", c_int), ("year", c_int)]
-
-class MasterBusTime(Structure):
-    _fields_ = [("sec", c_int), ("min", c_int), ("hour", c_int), ("days", c_uint32)]
-
-MasterBusDeviceID = c_uint32
-MasterBusFieldID = c_int32
-MasterBusGroupID = c_int32
-ValueType = c_int
-
-# --- Function Prototypes (argtypes and restype) ---
-
-def setup_prototypes():
-    # Helper to avoid cluttering the global namespace
-    
-    # Connection
-    libmasterbus.masterbus_api_socketcan.argtypes = [c_char_p]
-    libmasterbus.masterbus_api_socketcan.restype = POINTER(MasterBusAPIContext)
-    
-    # Memory Management
-    libmasterbus.masterbus_free.argtypes = [POINTER(MasterBusAPIContext)]
-    libmasterbus.masterbus_free.restype = None
-    libmasterbus.masterbus_free_device_list.argtypes = [POINTER(MasterBusDeviceID), c_int]
-    libmasterbus.masterbus_free_field_list.argtypes = [POINTER(MasterBusFieldID), c_int]
-    libmasterbus.masterbus_free_str.argtypes = [c_char_p]
-    libmasterbus.masterbus_free_value.argtypes = [POINTER(MasterBusValue)]
-
-    # Device Info
-    libmasterbus.masterbus_devices.argtypes = [POINTER(MasterBusAPIContext), POINTER(POINTER(MasterBusDeviceID))]
-    libmasterbus.masterbus_devices.restype = c_int
-    libmasterbus.masterbus_device_name.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
-    libmasterbus.masterbus_device_name.restype = c_int
-    libmasterbus.masterbus_device_article_number.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
-    libmasterbus.masterbus_device_article_number.restype = c_int
-    libmasterbus.masterbus_device_serial_number.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
-    libmasterbus.masterbus_device_serial_number.restype = c_int
-    libmasterbus.masterbus_device_firmware_version.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
-    libmasterbus.masterbus_device_firmware_version.restype = c_int
-    libmasterbus.masterbus_device_extended_firmware_version.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
-    libmasterbus.masterbus_device_extended_firmware_version.restype = c_int
-    libmasterbus.masterbus_device_status.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID]
-    libmasterbus.masterbus_device_status.restype = c_int
-
-    # Monitoring Groups & Fields
-    libmasterbus.masterbus_device_nr_of_monitoring_groups.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID]
-    libmasterbus.masterbus_device_nr_of_monitoring_groups.restype = c_int
-    libmasterbus.masterbus_monitoring_group_name.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusGroupID, POINTER(c_char_p)]
-    libmasterbus.masterbus_monitoring_group_name.restype = c_int
-    libmasterbus.masterbus_monitoring_group_fields.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusGroupID, POINTER(POINTER(MasterBusFieldID))]
-    libmasterbus.masterbus_monitoring_group_fields.restype = c_int
-    libmasterbus.masterbus_monitoring_field_name.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID, POINTER(c_char_p)]
-    libmasterbus.masterbus_monitoring_field_name.restype = c_int
-    libmasterbus.masterbus_monitoring_field_unit.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID, POINTER(c_char_p)]
-    libmasterbus.masterbus_monitoring_field_unit.restype = c_int
-    
-    # Value Reading
-    libmasterbus.masterbus_monitoring_field_value.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID]
-    libmasterbus.masterbus_monitoring_field_value.restype = POINTER(MasterBusValue)
-    libmasterbus.masterbus_value_type.argtypes = [POINTER(MasterBusValue)]
-    libmasterbus.masterbus_value_type.restype = ValueType
-    libmasterbus.masterbus_value_get_float.argtypes = [POINTER(MasterBusValue)]
-    libmasterbus.masterbus_value_get_float.restype = c_float
-    libmasterbus.masterbus_value_get_boolean.argtypes = [POINTER(MasterBusValue)]
-    libmasterbus.masterbus_value_get_boolean.restype = c_bool
-    libmasterbus.masterbus_value_get_date.argtypes = [POINTER(MasterBusValue)]
-    libmasterbus.masterbus_value_get_date.restype = MasterBusDate
-    libmasterbus.masterbus_value_get_time.argtypes = [POINTER(MasterBusValue)]
-    libmasterbus.masterbus_value_get_time.restype = MasterBusTime
-    libmasterbus.masterbus_value_get_string.argtypes = [POINTER(MasterBusValue), POINTER(c_char_p)]
-    libmasterbus.masterbus_value_get_string.restype = c_int
-    libmasterbus.masterbus_value_get_list_index.argtypes = [POINTER(MasterBusValue)]
-    libmasterbus.masterbus_value_get_list_index.restype = c_int
-    libmasterbus.masterbus_value_get_list_size.argtypes = [POINTER(MasterBusValue)]
-    libmasterbus.masterbus_value_get_list_size.restype = c_int
-    libmasterbus.masterbus_value_get_list_string.argtypes = [POINTER(MasterBusValue), c_int, POINTER(c_char_p)]
-    libmasterbus.masterbus_value_get_list_string.restype = c_int
-    libmasterbus.masterbus_value_get_list_device_id.argtypes = [POINTER(MasterBusValue), c_int]
-    libmasterbus.masterbus_value_get_list_device_id.restype = MasterBusDeviceID
-
-    # Value Writing
-    libmasterbus.masterbus_set_boolean.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID, c_bool]
-    libmasterbus.masterbus_set_boolean.restype = POINTER(MasterBusValue)
-
-setup_prototypes()
+    import orjson
+except ImportError:
+    orjson = None
+
+# --- Configuration ---
+
+def parse_poll_fields(spec: str):
+    """Parses comma separated 'device_id:field_id:interval_seconds' entries."""
+    fields = {}
+    for entry in filter(None, spec.replace(" ", "").split(",")):
+        device_id, field_id, interval = entry.split(":")
+        fields[(int(device_id), int(field_id))] = float(interval)
+    return fields
+
+# SocketCAN ports with a MasterBus, comma separated. Each port gets its own context and thread.
+PORTS = [port for port in os.environ.get("MASTERBUS_PORTS", "can1").replace(" ", "").split(",") if port]
+
+# Fields kept fresh by the background poller, each with its own refresh interval.
+# Defaults to the battery and charger fields read by the bridge.
+POLL_FIELDS = parse_poll_fields(os.environ.get("MASTERBUS_POLL_FIELDS", "7165674:0:5,7165674:1:1,7165674:2:1,7165674:5:10,2667145:15:1"))
+
+# How often (seconds) the poller checks the device list for changes that invalidate the catalog
+CATALOG_CHECK_INTERVAL = float(os.environ.get("MASTERBUS_CATALOG_CHECK_INTERVAL", "30"))
+
+# Fields whose numeric values are recorded for the history endpoint, as comma separated
+# 'device_id:field_id' entries. Recording is off when empty.
+HISTORY_FIELDS = [tuple(int(part) for part in entry.split(":")) for entry in filter(None, os.environ.get("MASTERBUS_HISTORY_FIELDS", "").replace(" ", "").split(","))]
+
+# History buckets kept per field, as 'resolution_seconds:buckets' entries.
+# Defaults to 1 s for 6 hours, 1 min for 14 days and 1 hour for a year (about 1 MB per field).
+HISTORY_TIERS = history.parse_tiers(os.environ.get("MASTERBUS_HISTORY_TIERS", "1:21600,60:20160,3600:8760"))
+
+# File the catalogs, device lists and latest values are saved to every SNAPSHOT_INTERVAL seconds
+# and on shutdown, and restored from on startup. Nothing is saved when empty, the default;
+# docker-compose keeps it on a volume.
+SNAPSHOT_FILE = os.environ.get("MASTERBUS_SNAPSHOT_FILE", "")
+SNAPSHOT_INTERVAL = float(os.environ.get("MASTERBUS_SNAPSHOT_INTERVAL", "60"))
+# Saved values older than this (seconds) are not restored
+SNAPSHOT_MAX_AGE = float(os.environ.get("MASTERBUS_SNAPSHOT_MAX_AGE", "30"))
 
 # --- FastAPI Application ---
 
-# Global context for the MasterBus API
-ctx = None
+# Priorities of the calls queued for a bus's thread, lowest first: control writes go ahead of any read
+WRITE_PRIORITY = 0
+READ_PRIORITY = 1
+
+class PriorityExecutor:
+    """
+    A single worker thread running the calls submitted to it by priority, lowest first,
+    and in submission order within a priority.
+    """
+    def __init__(self, port: str):
+        self.port = port
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.thread = threading.Thread(target=self.run, name=f"masterbus-{port}", daemon=True)
+        self.thread.start()
+
+    def submit(self, priority: int, func, *args):
+        future = Future()
+        self.queue.put((priority, next(self.counter), time.perf_counter(), future, func, args))
+        return future
+
+    def run(self):
+        while True:
+            priority, _, queued, future, func, args = self.queue.get()
+            if func is None:
+                return
+            BUS_QUEUE_SECONDS.observe(time.perf_counter() - queued, self.port, str(priority))
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self):
+        """Stops the thread once every call queued so far has run."""
+        self.queue.put((math.inf, next(self.counter), 0.0, None, None, ()))
+        self.thread.join()
+
+class MasterBusPort:
+    """
+    A MasterBus on one SocketCAN port. Every libmasterbus call for the port runs on the port's
+    single thread, which also owns its context, so calls are serialized per bus instead of racing
+    on a thread pool. Queued writes run before queued reads. Ports don't wait on each other:
+    ctypes releases the GIL during library calls.
+    """
+    def __init__(self, port: str):
+        self.port = port
+        self.ctx = None
+        self.executor = PriorityExecutor(port)
+        # Device -> monitoring group -> field metadata tree, built on first use.
+        # Dropped whenever the device list differs from the one it was built from.
+        self.catalog = None
+        self.catalog_devices = None
+        self.catalog_lock = asyncio.Lock()
+        # Device list last read from the bus; the cached option texts of devices joining or leaving it are dropped
+        self.known_devices = None
+        # Whether the catalog was restored from the snapshot file and has yet to be read from the bus again
+        self.catalog_restored = False
+
+# MasterBusPort of every configured port, in PORTS order
+buses = {}
+
+# Port each device was last seen on. The /api/devices/... endpoints send a device's calls to
+# that port, or to the first port for devices not seen yet.
+device_ports = {}
+
+# Bus reads currently in flight, keyed by (port, device_id, field_id), so that concurrent
+# requests for the same field share one read instead of queueing duplicates.
+inflight_reads = {}
+
+# Writes queued for the bus and not started yet, keyed by (port, device_id, field_id): the value
+# and future of the field's last queued write, which an identical write can wait for instead
+pending_writes = {}
+
+# Latest decoded value of each field read so far, keyed by (device_id, field_id).
+# Each entry is a value response with the time it was read in its 'timestamp' key.
+snapshots = {}
+
+# Set and immediately cleared whenever a snapshot is stored, waking up the value streams
+snapshot_stored = asyncio.Event()
+
+# Pollers and other tasks running in the background, kept here so that they aren't garbage
+# collected while running and are cancelled on shutdown
+background_tasks = set()
+
+# Recorded history of each HISTORY_FIELDS field, preallocated at startup
+histories = {field: history.FieldHistory(HISTORY_TIERS) for field in HISTORY_FIELDS}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global ctx
-    port = "can1"
-    encoded_port = port.encode('utf-8')
-    ctx = libmasterbus.masterbus_api_socketcan(encoded_port)
-    if not ctx:
-        raise RuntimeError(f"Failed to connect to SocketCAN port '{port}' on startup.")
-    
-    print(f"Successfully connected to MasterBus on {port}")
+    for port in PORTS:
+        buses[port] = MasterBusPort(port)
+    if SNAPSHOT_FILE:
+        load_snapshot_file()
+    for port, bus in buses.items():
+        try:
+            bus.ctx = await run_on_bus(bus, masterbus.connect_socketcan, port)
+            print(f"Successfully connected to MasterBus on {port}")
+        except HTTPException:
+            print(f"Failed to connect to SocketCAN port '{port}' on startup.")
+    if not connected_buses():
+        raise RuntimeError(f"Failed to connect to any of the SocketCAN ports {', '.join(PORTS)} on startup.")
+    if histories:
+        print(f"Recording history of {len(histories)} fields in {history.memory_size(HISTORY_TIERS, len(histories)) / 1e6:.1f} MB")
+
+    for bus in connected_buses():
+        start_background_task(poll_masterbus(bus))
+    if SNAPSHOT_FILE:
+        start_background_task(save_snapshot_file_periodically())
     yield
-    
-    if ctx:
-        libmasterbus.masterbus_free(ctx)
-        print("Successfully disconnected from MasterBus")
 
-app = FastAPI(lifespan=lifespan)
+    for task in list(background_tasks):
+        task.cancel()
+    if SNAPSHOT_FILE:
+        await save_snapshot_file()
+    for bus in buses.values():
+        if bus.ctx:
+            await run_on_bus(bus, libmasterbus.masterbus_free, bus.ctx)
+            print(f"Successfully disconnected from MasterBus on {bus.port}")
+        bus.executor.shutdown()
+    buses.clear()
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response serialized with orjson when it is installed, which is several times faster than
+    the json module. orjson writes NaN and infinite floats as null, which the json module can't send.
+    """
+    def render(self, content):
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# --- Metrics ---
+
+REQUEST_SECONDS = metrics.Histogram("api_request_seconds", "Time until the response headers were sent, per endpoint.", ["method", "route"])
+REQUESTS = metrics.Counter("api_requests_total", "Requests answered, per endpoint and status code.", ["method", "route", "status"])
+BUS_QUEUE_SECONDS = metrics.Histogram("api_bus_queue_seconds", "Time libmasterbus calls waited for their port's thread, per port and priority (0 = write, 1 = read).", ["port", "priority"])
+WRITE_SECONDS = metrics.Histogram("api_write_seconds", "Time from a control write being requested until the bus confirmed the new state, per port.", ["port"])
+WRITES_MERGED = metrics.Counter("api_writes_merged_total", "Control writes answered by an identical write already queued for the same field, per port.", ["port"])
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing every request, labelled by the route's path template."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = None
+
+        def record(status_code):
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], path)
+            REQUESTS.inc(scope["method"], path, str(status_code))
+
+        async def send_and_record(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                record(status)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        except Exception:
+            # Unhandled errors are turned into a 500 response outside of this middleware
+            if status is None:
+                record(500)
+            raise
+
+if metrics.ENABLED:
+    app.add_middleware(RequestMetricsMiddleware)
+
+    @app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+    async def get_metrics():
+        return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 class SetBooleanRequest(BaseModel):
     value: bool
 
-def get_ctx():
-    if not ctx:
-        raise HTTPException(status_code=503, detail="MasterBus context not available. Connection may have failed on startup.")
-    return ctx
+class FieldRef(BaseModel):
+    device_id: int
+    field_id: int
+
+class ValuesRequest(BaseModel):
+    fields: list[FieldRef]
+    max_age: float | None = None
+
+def connected_buses():
+    return [bus for bus in buses.values() if bus.ctx]
+
+def bus_for_device(device_id: int):
+    return buses[device_ports.get(device_id, PORTS[0])]
+
+# The dependencies below are async so that FastAPI runs them on the event loop; plain functions
+# would each be sent to its thread pool and back on every request.
+async def port_bus(request: Request):
+    """The bus of the port in a /api/ports/{port}/... path, None for the other endpoints."""
+    port = request.path_params.get("port")
+    if port is None:
+        return None
+    if port not in buses:
+        raise HTTPException(status_code=404, detail=f"Unknown MasterBus port '{port}'")
+    return buses[port]
+
+async def device_bus(device_id: int, bus: MasterBusPort | None = Depends(port_bus)):
+    """The bus of the port in the path, or else the one the device was last seen on."""
+    return bus or bus_for_device(device_id)
+
+def get_ctx(bus: MasterBusPort):
+    if not bus.ctx:
+        raise HTTPException(status_code=503, detail=f"MasterBus context for port '{bus.port}' not available. Connection may have failed on startup.")
+    return bus.ctx
+
+async def run_on_bus(bus: MasterBusPort, func, *args, priority: int = READ_PRIORITY):
+    """Runs a blocking libmasterbus helper on the bus's thread, turning its failures into HTTP 500 errors."""
+    try:
+        return await asyncio.wrap_future(bus.executor.submit(priority, func, *args))
+    except MasterBusError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-def process_value(value_ptr: POINTER(MasterBusValue), device_id: int, field_id: int):
-    """Helper function to convert a MasterBusValue pointer to a JSON response."""
-    if not value_ptr:
-        raise HTTPException(status_code=500, detail="Failed to get or set value from MasterBus.")
-    
+async def write_boolean(bus: MasterBusPort, device_id: int, field_id: int, value: bool):
+    """
+    Sets a boolean field ahead of any queued reads, and stores the new state the bus confirmed
+    as the field's latest snapshot. A write identical to the field's last queued one that hasn't
+    started yet waits for that write instead of queueing another.
+    """
+    start = time.perf_counter()
+    key = (bus.port, device_id, field_id)
+    pending = pending_writes.get(key)
+    if pending and pending[0] == value and not (pending[1].running() or pending[1].done()):
+        WRITES_MERGED.inc(bus.port)
+        write = pending[1]
+    else:
+        write = bus.executor.submit(WRITE_PRIORITY, masterbus.write_boolean, get_ctx(bus), device_id, field_id, value)
+        pending_writes[key] = (value, write)
     try:
-        v_type = libmasterbus.masterbus_value_type(value_ptr)
-        response = {"device_id": device_id, "field_id": field_id, "value_type": v_type}
-        
-        # VALUE_TYPE_FLOAT = 0
-        if v_type == 0: response["value"] = libmasterbus.masterbus_value_get_float(value_ptr)
-        # VALUE_TYPE_DATE = 1
-        elif v_type == 1: 
-            date_val = libmasterbus.masterbus_value_get_date(value_ptr)
-            response["value"] = f"{date_val.year:04d}-{date_val.mon:02d}-{date_val.day:02d}"
-        # VALUE_TYPE_TIME = 2
-        elif v_type == 2:
-            time_val = libmasterbus.masterbus_value_get_time(value_ptr)
-            response["value"] = f"{time_val.days}d {time_val.hour:02d}:{time_val.min:02d}:{time_val.sec:02d}"
-        # VALUE_TYPE_BOOLEAN = 3
-        elif v_type == 3: response["value"] = libmasterbus.masterbus_value_get_boolean(value_ptr)
-        # VALUE_TYPE_LIST_OPTION = 4, VALUE_TYPE_DEVICE_ID = 6, VALUE_TYPE_EVENTABLE = 7
-        elif v_type in [4, 6, 7]:
-            index = libmasterbus.masterbus_value_get_list_index(value_ptr)
-            size = libmasterbus.masterbus_value_get_list_size(value_ptr)
-            options = []
-            for i in range(size):
-                str_ptr = c_char_p()
-                if v_type == 6: # Device ID list
-                    dev_id = libmasterbus.masterbus_value_get_list_device_id(value_ptr, i)
-                    options.append({"index": i, "device_id": dev_id})
-                else: # List Option or Eventable
-                    libmasterbus.masterbus_value_get_list_string(value_ptr, i, byref(str_ptr))
-                    options.append({"index": i, "text": str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else None})
-                    libmasterbus.masterbus_free_str(str_ptr)
-            response["value"] = {"selectedIndex": index, "options": options}
-        # VALUE_TYPE_TEXT = 5
-        elif v_type == 5:
-            str_ptr = c_char_p()
-            libmasterbus.masterbus_value_get_string(value_ptr, byref(str_ptr))
-            response["value"] = str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else None
-            libmasterbus.masterbus_free_str(str_ptr)
-        else:
-            response["value"] = "Unsupported or invalid value type"
+        # Shielded so that one client disconnecting doesn't cancel the write for the others
+        response = dict(await asyncio.shield(asyncio.wrap_future(write)))
+    except MasterBusError as e:
+        raise HTTPException(status_code=500, detail=str(e))
     finally:
-        libmasterbus.masterbus_free_value(value_ptr)
-        
+        if pending_writes.get(key, (None, None))[1] is write:
+            del pending_writes[key]
+    WRITE_SECONDS.observe(time.perf_counter() - start, bus.port)
+    response["timestamp"] = time.time()
+    snapshots[(device_id, field_id)] = response
+    snapshot_stored.set()
+    snapshot_stored.clear()
     return response
 
-# --- API Endpoints ---
+async def store_field_value(bus: MasterBusPort, device_id: int, field_id: int):
+    """Reads a field value from the bus and stores it as the field's latest snapshot."""
+    response = await run_on_bus(bus, masterbus.read_field_value, get_ctx(bus), device_id, field_id)
+    response["timestamp"] = time.time()
+    snapshots[(device_id, field_id)] = response
+    field_history = histories.get((device_id, field_id))
+    if field_history and response["value_type"] == 0 and not math.isnan(response["value"]):
+        field_history.add(response["timestamp"], response["value"])
+    snapshot_stored.set()
+    snapshot_stored.clear()
+    return response
 
-@app.get("/api/devices", summary="Get all device IDs")
-def get_devices():
-    devices_ptr = POINTER(MasterBusDeviceID)()
-    count = libmasterbus.masterbus_devices(get_ctx(), byref(devices_ptr))
-    if count < 0: raise HTTPException(status_code=500, detail=f"Failed to get devices (err: {count})")
+async def fetch_field_value(bus: MasterBusPort, device_id: int, field_id: int):
+    """
+    Reads and stores a field value like store_field_value(), but concurrent calls
+    for the same field wait for the read that is already in flight.
+    """
+    key = (bus.port, device_id, field_id)
+    read = inflight_reads.get(key)
+    if read is None:
+        read = asyncio.ensure_future(store_field_value(bus, device_id, field_id))
+        inflight_reads[key] = read
+        read.add_done_callback(lambda _: inflight_reads.pop(key, None))
+    # Shielded so that one client disconnecting doesn't cancel the read for the others
+    return await asyncio.shield(read)
+
+def update_device_set(bus: MasterBusPort, device_ids: list[int]):
+    """
+    Records which devices are on the bus, and drops its catalog and cached option texts
+    that may be outdated after the device set changed.
+    """
+    device_ids = frozenset(device_ids)
+    if bus.known_devices is not None and bus.known_devices != device_ids:
+        masterbus.clear_option_cache(bus.known_devices ^ device_ids)
+        for device_id in bus.known_devices - device_ids:
+            if device_ports.get(device_id) == bus.port:
+                del device_ports[device_id]
+    for device_id in device_ids:
+        device_ports[device_id] = bus.port
+    bus.known_devices = device_ids
+    if bus.catalog_devices is not None and bus.catalog_devices != device_ids:
+        bus.catalog, bus.catalog_devices = None, None
+
+async def read_catalog(bus: MasterBusPort):
+    """Reads the catalog tree of a bus, returning it with the device list it was built from."""
+    device_ids = await get_devices(bus)
+    # One device per bus job, so value reads can interleave with a long catalog walk
+    catalog = [{**await run_on_bus(bus, masterbus.read_catalog_device, get_ctx(bus), device_id), "port": bus.port} for device_id in device_ids]
+    return catalog, frozenset(device_ids)
+
+async def refresh_restored_catalog(bus: MasterBusPort):
+    """
+    Reads a catalog restored from the snapshot file from the bus again, serving the restored one
+    meanwhile. The new catalog only replaces the restored one if that is still cached and the
+    device list didn't change during the read; otherwise it may already be outdated, and
+    /api/catalog reads the catalog again once needed.
+    """
+    restored = bus.catalog
     try:
-        return [devices_ptr[i] for i in range(count)]
-    finally:
-        libmasterbus.masterbus_free_device_list(devices_ptr, count)
-
-def get_string_from_library(func, device_id: int, a_name: str):
-    """Helper for funcs that return a string."""
-    str_ptr = c_char_p()
-    result = func(get_ctx(), device_id, byref(str_ptr))
-    if result < 0: raise HTTPException(status_code=500, detail=f"Failed to get {a_name} (err: {result})")
+        catalog, catalog_devices = await read_catalog(bus)
+    except HTTPException:
+        return # Dropped with the next device list change, or read again by /api/catalog once dropped
+    async with bus.catalog_lock:
+        if bus.catalog is restored and bus.known_devices == catalog_devices:
+            bus.catalog, bus.catalog_devices = catalog, catalog_devices
+
+# --- Snapshot File ---
+# Lets a restarted service answer right away with what it knew before, while the pollers
+# read the device lists and values again and refresh_restored_catalog() rereads the catalogs.
+
+def load_snapshot_file():
+    """Restores the catalogs, device lists and values at most SNAPSHOT_MAX_AGE seconds old from SNAPSHOT_FILE."""
     try:
-        return str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else None
-    finally:
-        libmasterbus.masterbus_free_str(str_ptr)
-
-@app.get("/api/devices/{device_id}/name", summary="Get device name")
-def get_device_name(device_id: int):
-    return {"name": get_string_from_library(libmasterbus.masterbus_device_name, device_id, "name")}
-
-@app.get("/api/devices/{device_id}/article_number", summary="Get device article number")
-def get_device_article_number(device_id: int):
-    return {"article_number": get_string_from_library(libmasterbus.masterbus_device_article_number, device_id, "article number")}
-
-@app.get("/api/devices/{device_id}/serial_number", summary="Get device serial number")
-def get_device_serial_number(device_id: int):
-    return {"serial_number": get_string_from_library(libmasterbus.masterbus_device_serial_number, device_id, "serial number")}
-
-@app.get("/api/devices/{device_id}/firmware_version", summary="Get device firmware version")
-def get_device_firmware_version(device_id: int):
-    return {"firmware_version": get_string_from_library(libmasterbus.masterbus_device_firmware_version, device_id, "firmware version")}
-
-@app.get("/api/devices/{device_id}/extended_firmware_version", summary="Get device extended firmware version")
-def get_device_extended_firmware_version(device_id: int):
-    return {"extended_firmware_version": get_string_from_library(libmasterbus.masterbus_device_extended_firmware_version, device_id, "extended firmware version")}
-
-@app.get("/api/devices/{device_id}/status", summary="Get device status")
-def get_device_status(device_id: int):
-    status = libmasterbus.masterbus_device_status(get_ctx(), device_id)
-    if status < 0: raise HTTPException(status_code=500, detail=f"Failed to get status (err: {status})")
-    return {"status_code": status}
-
-@app.get("/api/devices/{device_id}/monitoring_groups", summary="Get all monitoring groups for a device")
-def get_monitoring_groups(device_id: int):
-    count = libmasterbus.masterbus_device_nr_of_monitoring_groups(get_ctx(), device_id)
-    if count < 0: raise HTTPException(status_code=500, detail=f"Failed to get group count (err: {count})")
-    groups = []
-    for i in range(count):
-        str_ptr = c_char_p()
-        libmasterbus.masterbus_monitoring_group_name(get_ctx(), device_id, i, byref(str_ptr))
-        groups.append({"group_id": i, "name": str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else f"Group {i}"})
-        libmasterbus.masterbus_free_str(str_ptr)
-    return groups
-
-@app.get("/api/devices/{device_id}/monitoring_groups/{group_id}/fields", summary="Get all fields in a monitoring group")
-def get_monitoring_group_fields(device_id: int, group_id: int):
-    fields_ptr = POINTER(MasterBusFieldID)()
-    count = libmasterbus.masterbus_monitoring_group_fields(get_ctx(), device_id, group_id, byref(fields_ptr))
-    if count < 0: raise HTTPException(status_code=500, detail=f"Failed to get fields (err: {count})")
+        with open(SNAPSHOT_FILE) as f:
+            saved = json.load(f)
+        for port, state in saved["ports"].items():
+            bus = buses.get(port)
+            if bus is None:
+                continue
+            if state["devices"] is not None:
+                bus.known_devices = frozenset(state["devices"])
+                for device_id in bus.known_devices:
+                    device_ports[device_id] = port
+            if state["catalog"] is not None:
+                bus.catalog, bus.catalog_devices, bus.catalog_restored = state["catalog"], frozenset(state["catalog_devices"]), True
+        now = time.time()
+        for response in saved["values"]:
+            if now - response["timestamp"] <= SNAPSHOT_MAX_AGE:
+                snapshots[(response["device_id"], response["field_id"])] = response
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring snapshot file '{SNAPSHOT_FILE}': {e!r}")
+        return
+    print(f"Restored {sum(bus.catalog_restored for bus in buses.values())} catalogs and {len(snapshots)} values from '{SNAPSHOT_FILE}'")
+
+def write_file_atomically(path: str, contents: str):
+    """Writes a file through a temporary one, so a crash never leaves it half written."""
+    with open(f"{path}.tmp", "w") as f:
+        f.write(contents)
+    os.replace(f"{path}.tmp", path)
+
+async def save_snapshot_file():
+    """Saves the catalogs, device lists and latest values to SNAPSHOT_FILE."""
+    def sorted_or_none(device_ids):
+        return sorted(device_ids) if device_ids is not None else None
+
+    contents = json.dumps({
+        "ports": {bus.port: {"devices": sorted_or_none(bus.known_devices), "catalog": bus.catalog, "catalog_devices": sorted_or_none(bus.catalog_devices)} for bus in buses.values()},
+        "values": list(snapshots.values()),
+    })
     try:
-        return [fields_ptr[i] for i in range(count)]
-    finally:
-        libmasterbus.masterbus_free_field_list(fields_ptr, count)
+        await asyncio.to_thread(write_file_atomically, SNAPSHOT_FILE, contents)
+    except OSError as e:
+        print(f"Failed to save snapshot file '{SNAPSHOT_FILE}': {e}")
+
+async def save_snapshot_file_periodically():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        await save_snapshot_file()
+
+def parse_stream_fields(entries: list[str]):
+    """Parses 'device_id:field_id' or 'device_id:field_id:deadband' entries into a {field: deadband} dict."""
+    fields = {}
+    for entry in entries:
+        parts = entry.split(":")
+        try:
+            if len(parts) not in (2, 3): raise ValueError
+            fields[(int(parts[0]), int(parts[1]))] = float(parts[2]) if len(parts) == 3 else 0.0
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"Invalid field '{entry}', expected 'device_id:field_id[:deadband]'")
+    return fields
+
+def parse_packed_fields(entries: list[str]):
+    """Parses 'device_id:field_id' entries into a list of fields, each with IDs that fit the packed format."""
+    fields = []
+    for entry in entries:
+        try:
+            device_id, field_id = map(int, entry.split(":"))
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"Invalid field '{entry}', expected 'device_id:field_id'")
+        if device_id not in packed.DEVICE_IDS or field_id not in packed.FIELD_IDS:
+            raise HTTPException(status_code=422, detail=f"Field '{entry}' is out of range, device IDs are unsigned and field IDs signed 32 bit integers")
+        fields.append((device_id, field_id))
+    return fields
+
+def value_changed(old, new, deadband: float):
+    """Float values only count as changed once they moved more than the deadband."""
+    if isinstance(old, float) and isinstance(new, float):
+        if math.isnan(old) or math.isnan(new):
+            return math.isnan(old) != math.isnan(new)
+        return abs(new - old) > deadband
+    return old != new
+
+async def poll_masterbus(bus: MasterBusPort):
+    """
+    Background task of one bus, refreshing the snapshots of the POLL_FIELDS on its devices,
+    each at its own interval on fixed deadlines, and checking its device list for changes
+    every CATALOG_CHECK_INTERVAL seconds, starting right away.
+    """
+    start = time.monotonic()
+    next_poll = {field: start for field in POLL_FIELDS}
+    next_catalog_check = 0.0
+    while True:
+        try:
+            if next_catalog_check <= time.monotonic():
+                next_catalog_check = time.monotonic() + CATALOG_CHECK_INTERVAL
+                try:
+                    update_device_set(bus, await run_on_bus(bus, masterbus.read_devices, get_ctx(bus)))
+                except HTTPException:
+                    pass
+                # A restored catalog still matching the device list is reread in the background
+                if bus.catalog_restored:
+                    bus.catalog_restored = False
+                    if bus.catalog is not None:
+                        start_background_task(refresh_restored_catalog(bus))
+            for field, due in next_poll.items():
+                if due <= time.monotonic():
+                    next_poll[field] = next_deadline(due, POLL_FIELDS[field], time.monotonic())
+                    if bus_for_device(field[0]) is not bus:
+                        continue
+                    try:
+                        await fetch_field_value(bus, *field)
+                    except HTTPException:
+                        pass # Keep serving the previous snapshot, its timestamp shows its age
+        except Exception:
+            # Logged and polled on, as a dead poller would leave the snapshots stale for good
+            print(f"Polling MasterBus on {bus.port} failed:")
+            traceback.print_exc()
+            await asyncio.sleep(1)
+        await asyncio.sleep(max(0.0, min([*next_poll.values(), next_catalog_check]) - time.monotonic()))
+
+def log_stopped_task(task: asyncio.Task):
+    """Done callback of the background tasks, dropping the task and reporting it if it ended other than by being cancelled."""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task {task.get_name()} stopped: {task.exception()!r}")
+
+def start_background_task(coro):
+    """Runs a coroutine as a task in background_tasks until it ends."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(log_stopped_task)
+    return task
 
-@app.get("/api/devices/{device_id}/fields/{field_id}/name", summary="Get field name")
-def get_monitoring_field_name(device_id: int, field_id: int):
-    str_ptr = c_char_p()
-    result = libmasterbus.masterbus_monitoring_field_name(get_ctx(), device_id, field_id, byref(str_ptr))
-    if result < 0: raise HTTPException(status_code=500, detail=f"Failed to get field name (err: {result})")
-    try:
-        return {"name": str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else None}
-    finally:
-        libmasterbus.masterbus_free_str(str_ptr)
+# --- API Endpoints ---
+# Served under /api for all ports, and under /api/ports/{port} for a single port
 
-@app.get("/api/devices/{device_id}/fields/{field_id}/unit", summary="Get field unit")
-def get_monitoring_field_unit(device_id: int, field_id: int):
-    str_ptr = c_char_p()
-    result = libmasterbus.masterbus_monitoring_field_unit(get_ctx(), device_id, field_id, byref(str_ptr))
-    if result < 0: raise HTTPException(status_code=500, detail=f"Failed to get field unit (err: {result})")
-    try:
-        return {"unit": str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else None}
-    finally:
-        libmasterbus.masterbus_free_str(str_ptr)
+router = APIRouter()
 
-@app.get("/api/devices/{device_id}/fields/{field_id}/value", summary="Get field value")
-def get_monitoring_field_value(device_id: int, field_id: int):
-    value_ptr = libmasterbus.masterbus_monitoring_field_value(get_ctx(), device_id, field_id)
-    return process_value(value_ptr, device_id, field_id)
+@app.get("/api/ports", summary="Get the MasterBus ports")
+async def get_ports():
+    return [{"port": bus.port, "connected": bool(bus.ctx), "devices": sorted(bus.known_devices or [])} for bus in buses.values()]
 
-@app.post("/api/devices/{device_id}/fields/{field_id}/set_boolean", summary="Set a boolean value")
-def set_boolean_value(device_id: int, field_id: int, req_body: SetBooleanRequest):
+@app.get("/api/ready", summary="Check whether the API is ready")
+async def get_ready(fields: list[str] | None = Query(None)):
+    """
+    Ready (200) once a port is connected and every given 'device_id:field_id' field has a value,
+    read since startup or restored from the snapshot file. Without fields, the POLL_FIELDS are
+    checked. Answers 503 until then, listing the fields still missing.
+    """
+    required = parse_stream_fields(fields) if fields else POLL_FIELDS
+    missing = [f"{device_id}:{field_id}" for device_id, field_id in required if (device_id, field_id) not in snapshots]
+    ready = bool(connected_buses()) and not missing
+    return FastJSONResponse({"ready": ready, "missing": missing}, status_code=200 if ready else 503)
+
+@router.get("/devices", summary="Get all device IDs")
+async def get_devices(bus: MasterBusPort | None = Depends(port_bus)):
+    """Returns the devices on the port in the path, or on every connected port."""
+    device_ids = []
+    for bus in [bus] if bus else connected_buses():
+        bus_device_ids = await run_on_bus(bus, masterbus.read_devices, get_ctx(bus))
+        update_device_set(bus, bus_device_ids)
+        device_ids += bus_device_ids
+    return device_ids
+
+@router.get("/catalog", summary="Get the device, monitoring group and field metadata tree")
+async def get_catalog(bus: MasterBusPort | None = Depends(port_bus)):
+    """
+    Returns every device, with the port it is on, its monitoring groups and their fields
+    (name and unit), of the port in the path or of every connected port. The tree of a port
+    is read from its bus once and cached until its device list changes.
+    """
+    catalog = []
+    for bus in [bus] if bus else connected_buses():
+        async with bus.catalog_lock:
+            if bus.catalog is None:
+                bus.catalog, bus.catalog_devices = await read_catalog(bus)
+            catalog += bus.catalog
+    return catalog
+
+@router.get("/devices/{device_id}/name", summary="Get device name")
+async def get_device_name(device_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"name": await run_on_bus(bus, masterbus.get_string_from_library, get_ctx(bus), libmasterbus.masterbus_device_name, device_id, "name")}
+
+@router.get("/devices/{device_id}/article_number", summary="Get device article number")
+async def get_device_article_number(device_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"article_number": await run_on_bus(bus, masterbus.get_string_from_library, get_ctx(bus), libmasterbus.masterbus_device_article_number, device_id, "article number")}
+
+@router.get("/devices/{device_id}/serial_number", summary="Get device serial number")
+async def get_device_serial_number(device_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"serial_number": await run_on_bus(bus, masterbus.get_string_from_library, get_ctx(bus), libmasterbus.masterbus_device_serial_number, device_id, "serial number")}
+
+@router.get("/devices/{device_id}/firmware_version", summary="Get device firmware version")
+async def get_device_firmware_version(device_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"firmware_version": await run_on_bus(bus, masterbus.get_string_from_library, get_ctx(bus), libmasterbus.masterbus_device_firmware_version, device_id, "firmware version")}
+
+@router.get("/devices/{device_id}/extended_firmware_version", summary="Get device extended firmware version")
+async def get_device_extended_firmware_version(device_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"extended_firmware_version": await run_on_bus(bus, masterbus.get_string_from_library, get_ctx(bus), libmasterbus.masterbus_device_extended_firmware_version, device_id, "extended firmware version")}
+
+@router.get("/devices/{device_id}/status", summary="Get device status")
+async def get_device_status(device_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"status_code": await run_on_bus(bus, masterbus.read_device_status, get_ctx(bus), device_id)}
+
+@router.get("/devices/{device_id}/monitoring_groups", summary="Get all monitoring groups for a device")
+async def get_monitoring_groups(device_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return await run_on_bus(bus, masterbus.read_monitoring_groups, get_ctx(bus), device_id)
+
+@router.get("/devices/{device_id}/monitoring_groups/{group_id}/fields", summary="Get all fields in a monitoring group")
+async def get_monitoring_group_fields(device_id: int, group_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return await run_on_bus(bus, masterbus.read_monitoring_group_fields, get_ctx(bus), device_id, group_id)
+
+@router.get("/devices/{device_id}/fields/{field_id}/name", summary="Get field name")
+async def get_monitoring_field_name(device_id: int, field_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"name": await run_on_bus(bus, masterbus.get_field_string_from_library, get_ctx(bus), libmasterbus.masterbus_monitoring_field_name, device_id, field_id, "field name")}
+
+@router.get("/devices/{device_id}/fields/{field_id}/unit", summary="Get field unit")
+async def get_monitoring_field_unit(device_id: int, field_id: int, bus: MasterBusPort = Depends(device_bus)):
+    return {"unit": await run_on_bus(bus, masterbus.get_field_string_from_library, get_ctx(bus), libmasterbus.masterbus_monitoring_field_unit, device_id, field_id, "field unit")}
+
+@router.get("/devices/{device_id}/fields/{field_id}/value", summary="Get field value")
+async def get_monitoring_field_value(device_id: int, field_id: int, max_age: float | None = None, bus: MasterBusPort = Depends(device_bus)):
+    """
+    Fields refreshed by the background poller are answered from their latest snapshot.
+    Other fields are read from the bus, unless max_age is given: then any snapshot at most
+    max_age seconds old is returned, and an older one is refreshed with a live read.
+    """
+    snapshot = snapshots.get((device_id, field_id))
+    if snapshot:
+        if max_age is None:
+            if (device_id, field_id) in POLL_FIELDS:
+                return snapshot
+        elif time.time() - snapshot["timestamp"] <= max_age:
+            return snapshot
+    return await fetch_field_value(bus, device_id, field_id)
+
+@router.get("/devices/{device_id}/fields/{field_id}/history", summary="Get field value history")
+async def get_monitoring_field_history(device_id: int, field_id: int, start: float | None = None, end: float | None = None, resolution: float | None = None):
+    """
+    Returns min/max/mean/count buckets of a recorded field between the start and end
+    timestamps (default: the last hour), as parallel lists starting at 'timestamps'.
+    Buckets come from the finest recorded resolution still covering start, merged to
+    the requested resolution in seconds when that is coarser. Empty buckets are left out.
+    """
+    field_history = histories.get((device_id, field_id))
+    if field_history is None:
+        raise HTTPException(status_code=404, detail=f"History of field {field_id} on device {device_id} is not recorded")
+    if not all(math.isfinite(value) for value in (start, end, resolution) if value is not None):
+        raise HTTPException(status_code=422, detail="start, end and resolution must be finite numbers")
+    end = time.time() if end is None else end
+    start = end - 3600 if start is None else start
+    if resolution is not None and resolution <= 0:
+        raise HTTPException(status_code=422, detail="resolution must be positive")
+    # Returned as a ready response, as validating thousands of buckets would take longer than the query
+    return FastJSONResponse({"device_id": device_id, "field_id": field_id, **field_history.query(start, end, resolution)})
+
+async def read_field_values(fields, max_age: float | None, bus: MasterBusPort | None):
+    """
+    Reads (device_id, field_id) fields concurrently like the single value endpoint, returning
+    its response for each field, or an object with an 'error' key for fields that failed.
+    """
+    results = await asyncio.gather(
+        *(get_monitoring_field_value(device_id, field_id, max_age, bus or bus_for_device(device_id)) for device_id, field_id in fields),
+        return_exceptions=True,
+    )
+    for i, ((device_id, field_id), result) in enumerate(zip(fields, results)):
+        if isinstance(result, HTTPException):
+            results[i] = {"device_id": device_id, "field_id": field_id, "error": result.detail}
+        elif isinstance(result, BaseException):
+            raise result
+    return results
+
+@router.post("/values", summary="Get multiple field values")
+async def get_monitoring_field_values(req_body: ValuesRequest, bus: MasterBusPort | None = Depends(port_bus)):
+    """
+    Reads several field values in a single request, in the order they were given.
+    Each entry is either the same object returned by the single value endpoint, or
+    an object with an 'error' key if that particular field could not be read.
+    """
+    results = await read_field_values([(field.device_id, field.field_id) for field in req_body.fields], req_body.max_age, bus)
+    # Returned as a ready response, skipping FastAPI's conversion of the plain dicts
+    return FastJSONResponse(results)
+
+@lru_cache(maxsize=32)
+def packer(fields: tuple):
+    return packed.PackedValues(fields)
+
+def packed_number(result):
+    """The number packed for a value response: floats as is, booleans as 0 or 1, anything else NaN."""
+    if "error" in result:
+        return math.nan
+    if result["value_type"] == masterbus.VALUE_TYPE_FLOAT:
+        return result["value"]
+    if result["value_type"] == masterbus.VALUE_TYPE_BOOLEAN:
+        return float(result["value"])
+    return math.nan
+
+@router.get("/values/packed", summary="Get multiple numeric field values as packed floats")
+async def get_packed_field_values(fields: list[str] = Query(), max_age: float | None = None, bus: MasterBusPort | None = Depends(port_bus)):
+    """
+    Reads the given 'device_id:field_id' fields like POST /values, and returns them as a header
+    mapping each value to its field followed by little-endian 32 bit floats, as described in
+    packed.py. Values that could not be read or are not numeric are NaN.
+    """
+    requested = tuple(dict.fromkeys(parse_packed_fields(fields)))
+    if len(requested) > 0xFFFF:
+        raise HTTPException(status_code=422, detail="Too many fields")
+    results = await read_field_values(requested, max_age, bus)
+    timestamps = [result["timestamp"] for result in results if "timestamp" in result]
+    body = packer(requested).pack(min(timestamps, default=math.nan), [packed_number(result) for result in results])
+    return Response(body, media_type=packed.MEDIA_TYPE)
+
+@router.get("/stream", summary="Stream field value changes as Server-Sent Events")
+async def stream_field_values(fields: list[str] = Query(), interval: float = Query(0.5, gt=0), keepalive: float = Query(15.0, gt=0), bus: MasterBusPort | None = Depends(port_bus)):
+    """
+    Streams the given fields, each as 'device_id:field_id' or 'device_id:field_id:deadband'.
+    Every field's current value is sent first; after that a value is only sent when it changed,
+    and float values only once they moved more than their deadband from the last value sent.
+    Values are checked whenever a snapshot is stored and at least every interval seconds.
+    POLL_FIELDS are served from the poller's snapshots, so streaming them adds no bus reads;
+    other fields use snapshots up to interval seconds old. Every keepalive seconds a
+    'keepalive' event lists [device_id, field_id, timestamp] with the last read time of every
+    field, as unchanged values are not resent; a field whose reads fail keeps its old timestamp.
+    """
+    subscriptions = parse_stream_fields(fields)
+
+    async def events():
+        sent = {}
+        read_at = {}
+        last_keepalive = time.monotonic()
+        while True:
+            for (device_id, field_id), deadband in subscriptions.items():
+                max_age = None if (device_id, field_id) in POLL_FIELDS else interval
+                try:
+                    response = await get_monitoring_field_value(device_id, field_id, max_age, bus or bus_for_device(device_id))
+                except HTTPException:
+                    continue
+                key = (device_id, field_id)
+                read_at[key] = response["timestamp"]
+                if key not in sent or value_changed(sent[key], response["value"], deadband):
+                    sent[key] = response["value"]
+                    yield f"data: {json.dumps(response)}\n\n"
+            if time.monotonic() - last_keepalive >= keepalive:
+                last_keepalive = time.monotonic()
+                yield f"event: keepalive\ndata: {json.dumps([[*key, timestamp] for key, timestamp in read_at.items()])}\n\n"
+            try:
+                await asyncio.wait_for(snapshot_stored.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.post("/devices/{device_id}/fields/{field_id}/set_boolean", summary="Set a boolean value")
+async def set_boolean_value(device_id: int, field_id: int, req_body: SetBooleanRequest, bus: MasterBusPort = Depends(device_bus)):
     """
     Sets the value for a boolean field that holds a state (on/off).
     For triggering event-based actions like relays, use the /trigger endpoint.
-    The library returns the new state of the value after setting it.
+    Returns the new state of the value confirmed by the bus. Writes are sent ahead of any reads
+    waiting for the bus.
     """
-    value_ptr = libmasterbus.masterbus_set_boolean(get_ctx(), device_id, field_id, req_body.value)
-    return process_value(value_ptr, device_id, field_id)
+    return await write_boolean(bus, device_id, field_id, req_body.value)
 
-@app.post("/api/devices/{device_id}/fields/{field_id}/trigger", summary="Trigger an event field")
-def trigger_event(device_id: int, field_id: int):
+@router.post("/devices/{device_id}/fields/{field_id}/trigger", summary="Trigger an event field")
+async def trigger_event(device_id: int, field_id: int, bus: MasterBusPort = Depends(device_bus)):
     """
     Triggers an event-based field, such as 'Open relay' or 'Close relay'.
     This action does not require a request body. The library is called with a 'true' value
     to initiate the event. The returned value represents the new state.
     """
-    value_ptr = libmasterbus.masterbus_set_boolean(get_ctx(), device_id, field_id, True)
-    return process_value(value_ptr, device_id, field_id)
+    return await write_boolean(bus, device_id, field_id, True)
+
+app.include_router(router, prefix="/api")
+app.include_router(router, prefix="/api/ports/{port}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
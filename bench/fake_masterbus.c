@@ -0,0 +1,237 @@
+/*
+ * Stand-in for libmasterbus.so, implementing the masterbus_* functions used by masterbus.py
+ * without a MasterBus. Built by bench/run.py; point MASTERBUS_LIBRARY at the result.
+ *
+ * Configured with environment variables, read when the library is loaded:
+ *   FAKE_MASTERBUS_LATENCY_US  Microseconds every call that would talk to the bus sleeps (default 0).
+ *   FAKE_MASTERBUS_DEVICES     Comma separated device IDs (default "7165674,2667145").
+ *   FAKE_MASTERBUS_TYPES       Comma separated "field_id:value_type" overrides. Fields 100-107 have
+ *                              value types 0-7, every other field is a float.
+ *   FAKE_MASTERBUS_VALUES      File of 256 little-endian floats, mapped into memory: float field N
+ *                              reads entry N % 256, so another process can change values while
+ *                              this one runs. Without it float field N reads 50 + N.
+ */
+#include <fcntl.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+#define MAX_DEVICES 32
+#define FIELD_SLOTS 256
+#define LIST_SIZE 3
+
+typedef struct { int day, mon, year; } MasterBusDate;
+typedef struct { int sec, min, hour; uint32_t days; } MasterBusTime;
+typedef struct { int dummy; } MasterBusAPIContext;
+
+typedef struct {
+    int type;
+    float f;
+    bool b;
+    int index;
+} MasterBusValue;
+
+static MasterBusAPIContext context;
+static useconds_t latency_us;
+static uint32_t devices[MAX_DEVICES] = {7165674, 2667145};
+static int device_count = 2;
+static int types[FIELD_SLOTS];
+static bool booleans[FIELD_SLOTS];
+static volatile float *shared_values;
+
+static const char *list_texts[LIST_SIZE] = {"Off", "On", "Auto"};
+static const int32_t group_fields[] = {0, 1, 2, 5, 15, 100, 101, 102, 103, 104, 105, 106, 107};
+
+__attribute__((constructor)) static void configure(void) {
+    const char *env;
+
+    for (int i = 0; i < FIELD_SLOTS; i++)
+        types[i] = (i >= 100 && i <= 107) ? i - 100 : 0;
+
+    if ((env = getenv("FAKE_MASTERBUS_LATENCY_US")))
+        latency_us = (useconds_t)atoi(env);
+
+    if ((env = getenv("FAKE_MASTERBUS_DEVICES")) && *env) {
+        char *spec = strdup(env), *save = NULL;
+        device_count = 0;
+        for (char *item = strtok_r(spec, ",", &save); item && device_count < MAX_DEVICES; item = strtok_r(NULL, ",", &save))
+            devices[device_count++] = (uint32_t)strtoul(item, NULL, 10);
+        free(spec);
+    }
+
+    if ((env = getenv("FAKE_MASTERBUS_TYPES")) && *env) {
+        char *spec = strdup(env), *save = NULL;
+        for (char *item = strtok_r(spec, ",", &save); item; item = strtok_r(NULL, ",", &save)) {
+            char *colon = strchr(item, ':');
+            if (colon)
+                types[atoi(item) % FIELD_SLOTS] = atoi(colon + 1);
+        }
+        free(spec);
+    }
+
+    if ((env = getenv("FAKE_MASTERBUS_VALUES")) && *env) {
+        int fd = open(env, O_RDONLY);
+        if (fd >= 0) {
+            void *map = mmap(NULL, FIELD_SLOTS * sizeof(float), PROT_READ, MAP_SHARED, fd, 0);
+            if (map != MAP_FAILED)
+                shared_values = map;
+            close(fd);
+        }
+    }
+}
+
+static void bus_delay(void) {
+    if (latency_us)
+        usleep(latency_us);
+}
+
+static int copy_string(char **out, const char *text) {
+    *out = strdup(text);
+    return *out ? 0 : -1;
+}
+
+static bool known_device(uint32_t device_id) {
+    for (int i = 0; i < device_count; i++)
+        if (devices[i] == device_id)
+            return true;
+    return false;
+}
+
+static int field_slot(int32_t field_id) {
+    return (int)((uint32_t)field_id % FIELD_SLOTS);
+}
+
+/* Connection and memory management */
+
+MasterBusAPIContext *masterbus_api_socketcan(const char *port) { return &context; }
+void masterbus_free(MasterBusAPIContext *ctx) {}
+void masterbus_free_device_list(uint32_t *list, int count) { free(list); }
+void masterbus_free_field_list(int32_t *list, int count) { free(list); }
+void masterbus_free_str(char *str) { free(str); }
+void masterbus_free_value(MasterBusValue *value) { free(value); }
+
+/* Device info */
+
+int masterbus_devices(MasterBusAPIContext *ctx, uint32_t **out) {
+    bus_delay();
+    *out = malloc(device_count * sizeof(uint32_t));
+    memcpy(*out, devices, device_count * sizeof(uint32_t));
+    return device_count;
+}
+
+int masterbus_device_name(MasterBusAPIContext *ctx, uint32_t device_id, char **out) {
+    bus_delay();
+    return known_device(device_id) ? copy_string(out, "Fake device") : -1;
+}
+
+int masterbus_device_article_number(MasterBusAPIContext *ctx, uint32_t device_id, char **out) {
+    bus_delay();
+    return known_device(device_id) ? copy_string(out, "00000000") : -1;
+}
+
+int masterbus_device_serial_number(MasterBusAPIContext *ctx, uint32_t device_id, char **out) {
+    bus_delay();
+    return known_device(device_id) ? copy_string(out, "FAKE0001") : -1;
+}
+
+int masterbus_device_firmware_version(MasterBusAPIContext *ctx, uint32_t device_id, char **out) {
+    bus_delay();
+    return known_device(device_id) ? copy_string(out, "1.00") : -1;
+}
+
+int masterbus_device_extended_firmware_version(MasterBusAPIContext *ctx, uint32_t device_id, char **out) {
+    bus_delay();
+    return known_device(device_id) ? copy_string(out, "1.00.0") : -1;
+}
+
+int masterbus_device_status(MasterBusAPIContext *ctx, uint32_t device_id) {
+    bus_delay();
+    return known_device(device_id) ? 0 : -1;
+}
+
+/* Monitoring groups and fields: every device has one group with the same fields */
+
+int masterbus_device_nr_of_monitoring_groups(MasterBusAPIContext *ctx, uint32_t device_id) {
+    bus_delay();
+    return known_device(device_id) ? 1 : -1;
+}
+
+int masterbus_monitoring_group_name(MasterBusAPIContext *ctx, uint32_t device_id, int32_t group_id, char **out) {
+    bus_delay();
+    return known_device(device_id) && group_id == 0 ? copy_string(out, "General") : -1;
+}
+
+int masterbus_monitoring_group_fields(MasterBusAPIContext *ctx, uint32_t device_id, int32_t group_id, int32_t **out) {
+    bus_delay();
+    if (!known_device(device_id) || group_id != 0)
+        return -1;
+    *out = malloc(sizeof(group_fields));
+    memcpy(*out, group_fields, sizeof(group_fields));
+    return (int)(sizeof(group_fields) / sizeof(group_fields[0]));
+}
+
+int masterbus_monitoring_field_name(MasterBusAPIContext *ctx, uint32_t device_id, int32_t field_id, char **out) {
+    bus_delay();
+    return known_device(device_id) ? copy_string(out, "Fake field") : -1;
+}
+
+int masterbus_monitoring_field_unit(MasterBusAPIContext *ctx, uint32_t device_id, int32_t field_id, char **out) {
+    bus_delay();
+    return known_device(device_id) ? copy_string(out, "") : -1;
+}
+
+/* Values */
+
+MasterBusValue *masterbus_monitoring_field_value(MasterBusAPIContext *ctx, uint32_t device_id, int32_t field_id) {
+    bus_delay();
+    if (!known_device(device_id))
+        return NULL;
+    int slot = field_slot(field_id);
+    MasterBusValue *value = calloc(1, sizeof(MasterBusValue));
+    value->type = types[slot];
+    value->f = shared_values ? shared_values[slot] : 50.0f + (float)field_id;
+    value->b = booleans[slot];
+    value->index = 1;
+    return value;
+}
+
+int masterbus_value_type(MasterBusValue *value) { return value->type; }
+float masterbus_value_get_float(MasterBusValue *value) { return value->f; }
+bool masterbus_value_get_boolean(MasterBusValue *value) { return value->b; }
+
+MasterBusDate masterbus_value_get_date(MasterBusValue *value) {
+    MasterBusDate date = {1, 1, 2024};
+    return date;
+}
+
+MasterBusTime masterbus_value_get_time(MasterBusValue *value) {
+    MasterBusTime time = {30, 15, 12, 0};
+    return time;
+}
+
+int masterbus_value_get_string(MasterBusValue *value, char **out) { return copy_string(out, "Fake text"); }
+int masterbus_value_get_list_index(MasterBusValue *value) { return value->index; }
+int masterbus_value_get_list_size(MasterBusValue *value) { return value->type == 6 ? device_count : LIST_SIZE; }
+
+int masterbus_value_get_list_string(MasterBusValue *value, int index, char **out) {
+    return index >= 0 && index < LIST_SIZE ? copy_string(out, list_texts[index]) : -1;
+}
+
+uint32_t masterbus_value_get_list_device_id(MasterBusValue *value, int index) {
+    return index >= 0 && index < device_count ? devices[index] : 0;
+}
+
+MasterBusValue *masterbus_set_boolean(MasterBusAPIContext *ctx, uint32_t device_id, int32_t field_id, bool b) {
+    bus_delay();
+    if (!known_device(device_id))
+        return NULL;
+    int slot = field_slot(field_id);
+    booleans[slot] = b;
+    MasterBusValue *value = calloc(1, sizeof(MasterBusValue));
+    value->type = 3;
+    value->b = b;
+    return value;
+}
@@ -0,0 +1,447 @@
+"""
+Hardware-free benchmarks of the API service and the bridge.
+
+Builds bench/fake_masterbus.c into a stand-in libmasterbus and measures:
+  api         requests/s and p50/p99 latency of the value endpoints at several concurrencies,
+              and the latency of writes while clients keep the bus busy with reads
+  decode      values decoded per second by masterbus.process_value, per value type
+  encode      frames encoded per second by cantools and by the precompiled frames.py encoders,
+              for the messages the bridge updates every tick
+  bridge_tick time the bridge spends fetching its five fields from the API each tick: one GET
+              per field on a new connection each (as before the batch endpoint), one batched
+              POST /api/values, and the packed GET of the "http" value source
+  end_to_end  time from a MasterBus value changing to the updated frame on the inverter's
+              CAN interface, which needs a SocketCAN interface such as vcan0:
+                  sudo modprobe vcan
+                  sudo ip link add dev vcan0 type vcan && sudo ip link set up vcan0
+
+Results are printed as JSON, and written to --output when given, so runs can be compared.
+
+    python bench/run.py --latency-us 2000 --output results.json
+"""
+import argparse
+import http.client
+import json
+import mmap
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKE_SOURCE = os.path.join(BENCH_DIR, "fake_masterbus.c")
+FAKE_LIBRARY = os.path.join(BENCH_DIR, "build", "libmasterbus_fake.so")
+
+BATTERY_DEVICE_ID = 7165674
+CHARGER_DEVICE_ID = 2667145
+
+# Initial values of the bridge's fields in the shared values file, by field ID
+INITIAL_VALUES = {0: 80.0, 1: 53.0, 2: -3.0, 5: 25.0, 15: 0.0}
+
+# Field 100 + N of the fake library has value type N
+VALUE_TYPES = ["float", "date", "time", "boolean", "list_option", "text", "device_id", "eventable"]
+
+# --- Helpers ---
+
+def build_fake_library():
+    """Compiles the fake libmasterbus unless it is newer than its source."""
+    if os.path.exists(FAKE_LIBRARY) and os.path.getmtime(FAKE_LIBRARY) >= os.path.getmtime(FAKE_SOURCE):
+        return FAKE_LIBRARY
+    os.makedirs(os.path.dirname(FAKE_LIBRARY), exist_ok=True)
+    subprocess.run([os.environ.get("CC", "cc"), "-shared", "-fPIC", "-O2", "-o", FAKE_LIBRARY, FAKE_SOURCE], check=True)
+    return FAKE_LIBRARY
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+def latency_stats(latencies):
+    """Summarizes latencies in seconds as milliseconds."""
+    latencies = sorted(latencies)
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+    return {
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "mean_ms": ms(sum(latencies) / len(latencies) if latencies else None),
+    }
+
+def start_process(args, env):
+    return subprocess.Popen(args, cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+def stop_process(process):
+    if process and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def wait_for_api(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API exited during startup: {process.stderr.read().decode(errors='replace')}")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/api/devices")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("API did not become ready")
+
+# --- API Load ---
+
+def run_load(port, method, path, body, concurrency, duration):
+    """Sends requests from `concurrency` persistent connections for `duration` seconds."""
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    payload = json.dumps(body) if body is not None else None
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency + 1)
+    deadline = [0.0]
+
+    def worker():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local_latencies, local_errors = [], 0
+        start_barrier.wait()
+        while time.monotonic() < deadline[0]:
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=payload, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            local_latencies.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    deadline[0] = time.monotonic() + duration
+    start = time.monotonic()
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    return {"requests": len(latencies), "errors": errors[0], "requests_per_second": round(len(latencies) / elapsed, 1), **latency_stats(latencies)}
+
+def run_writes_under_load(port, concurrency, duration, interval=0.05):
+    """
+    Times set_boolean writes sent every `interval` seconds while `concurrency` clients each
+    keep reading a different field live, so their reads queue up on the bus.
+    """
+    stop = threading.Event()
+    reads = [0]
+    lock = threading.Lock()
+
+    def reader(field_id):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        count = 0
+        while not stop.is_set():
+            try:
+                connection.request("GET", f"/api/devices/{BATTERY_DEVICE_ID}/fields/{field_id}/value?max_age=0")
+                connection.getresponse().read()
+                count += 1
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        connection.close()
+        with lock:
+            reads[0] += count
+
+    # Float fields 20 and up, one per client
+    threads = [threading.Thread(target=reader, args=(20 + i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+    value = False
+    while time.monotonic() < deadline:
+        value = not value
+        start = time.perf_counter()
+        connection.request("POST", f"/api/devices/{BATTERY_DEVICE_ID}/fields/103/set_boolean", body=json.dumps({"value": value}), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors += 1
+        time.sleep(interval)
+    connection.close()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {"writes": len(latencies), "errors": errors, "reads_per_second": round(reads[0] / (duration + 0.5), 1), **latency_stats(latencies)}
+
+def bench_api(args, env):
+    scenarios = {
+        # Answered from the poller's snapshot
+        "polled_value": ("GET", f"/api/devices/{BATTERY_DEVICE_ID}/fields/1/value", None),
+        # Read from the bus on every request, with concurrent reads of the field coalesced
+        "live_value": ("GET", f"/api/devices/{BATTERY_DEVICE_ID}/fields/1/value?max_age=0", None),
+        # The bridge's batch request
+        "values_batch": ("POST", "/api/values", {"fields": [{"device_id": BATTERY_DEVICE_ID, "field_id": f} for f in (0, 1, 2, 5)] + [{"device_id": CHARGER_DEVICE_ID, "field_id": 15}]}),
+        # The same fields as packed floats, as fetched by the bridge's "http" value source
+        "values_packed": ("GET", "/api/values/packed?" + "&".join([f"fields={BATTERY_DEVICE_ID}:{f}" for f in (0, 1, 2, 5)] + [f"fields={CHARGER_DEVICE_ID}:15"]), None),
+    }
+    api = start_process([sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"], env)
+    try:
+        wait_for_api(args.port, api)
+        results = {}
+        selected = args.api_scenarios or [*scenarios, "write_under_load"]
+        for name, (method, path, body) in scenarios.items():
+            if name in selected:
+                results[name] = {str(c): run_load(args.port, method, path, body, c, args.duration) for c in args.concurrency}
+        if "write_under_load" in selected:
+            results["write_under_load"] = {str(c): run_writes_under_load(args.port, c, args.duration) for c in args.concurrency}
+        return results
+    finally:
+        stop_process(api)
+
+# --- Encoding ---
+
+# Signals of the messages the bridge updates every tick, as it sends them
+ENCODE_SIGNALS = {
+    "Network_alive_msg": {"Alive_packet": 17},
+    "Battery_SoC_SoH": {"SoC": 80, "SoH": 100},
+    "Battery_actual_values_UIt": {"Battery_voltage": 53.12, "Battery_current": -3.4, "Battery_temperature": 25.3},
+    "Battery_limits": {"Battery_discharge_current_limit": -100.0, "Battery_charge_current_limit": 80.0, "Battery_charge_voltage": 54.5, "Battery_discharge_voltage": 48.0},
+}
+
+def bench_encode(args):
+    """Encodes the bridge's messages with cantools and with the compiled encoders, in this process."""
+    import cantools
+    import frames
+    dbc_file = os.path.join(REPO_DIR, "pylon_CAN_210124.dbc")
+    db = cantools.database.load_file(dbc_file)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        encoders = frames.load_encoders(dbc_file, os.path.join(cache_dir, "frames.json"))
+    duration = min(args.duration, 2.0)
+    results = {}
+    for name, signals in ENCODE_SIGNALS.items():
+        results[name] = {}
+        for encoder_name, encode in (("cantools", db.get_message_by_name(name).encode), ("compiled", encoders[name].encode)):
+            count = 0
+            start = time.perf_counter()
+            deadline = start + duration
+            while time.perf_counter() < deadline:
+                for _ in range(1000):
+                    encode(signals)
+                count += 1000
+            results[name][f"{encoder_name}_per_second"] = round(count / (time.perf_counter() - start))
+    return results
+
+# --- Bridge Tick ---
+
+def bench_bridge_tick(args, env):
+    """Fetches the bridge's fields like one bridge tick, back to back, for each way of fetching them."""
+    import requests
+    import packed
+    fields = [(BATTERY_DEVICE_ID, f) for f in (0, 1, 2, 5)] + [(CHARGER_DEVICE_ID, 15)]
+    base_url = f"http://127.0.0.1:{args.port}/api"
+    session = requests.Session()
+    packer = packed.PackedValues(fields)
+    packed_params = [("fields", f"{d}:{f}") for d, f in fields]
+
+    def per_field():
+        for device_id, field_id in fields:
+            requests.get(f"{base_url}/devices/{device_id}/fields/{field_id}/value", timeout=5).json()
+
+    def batch():
+        session.post(f"{base_url}/values", json={"fields": [{"device_id": d, "field_id": f} for d, f in fields]}, timeout=5).json()
+
+    def packed_values():
+        packer.unpack(session.get(f"{base_url}/values/packed", params=packed_params, timeout=5).content)
+
+    api = start_process([sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"], env)
+    try:
+        wait_for_api(args.port, api)
+        results = {}
+        for name, fetch in {"per_field": per_field, "batch": batch, "packed": packed_values}.items():
+            fetch()  # Connects the session and fills the snapshots
+            latencies = []
+            deadline = time.monotonic() + args.duration
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                fetch()
+                latencies.append(time.perf_counter() - start)
+            results[name] = {"ticks": len(latencies), **latency_stats(latencies)}
+        return results
+    finally:
+        session.close()
+        stop_process(api)
+
+# --- Decoding ---
+
+def bench_decode(args):
+    """Decodes values of every type in this process, with the fake library's latency at 0."""
+    import masterbus
+    ctx = masterbus.connect_socketcan("fake")
+    duration = min(args.duration, 2.0)
+    results = {}
+    try:
+        for value_type, name in enumerate(VALUE_TYPES):
+            field_id = 100 + value_type
+            count = 0
+            start = time.perf_counter()
+            deadline = start + duration
+            while time.perf_counter() < deadline:
+                for _ in range(1000):
+                    masterbus.read_field_value(ctx, BATTERY_DEVICE_ID, field_id)
+                count += 1000
+            results[name] = {"values_per_second": round(count / (time.perf_counter() - start))}
+    finally:
+        masterbus.libmasterbus.masterbus_free(ctx)
+    return results
+
+# --- End to End ---
+
+def bench_end_to_end(args, env, values):
+    """Changes the battery voltage in the shared values file and times the updated CAN frame."""
+    try:
+        import can
+        listener = can.interface.Bus(channel=args.can_interface, interface="socketcan")
+    except Exception as e:
+        return {"skipped": f"CAN interface '{args.can_interface}' not available: {e}"}
+
+    sys.path.insert(0, REPO_DIR)
+    import bridge
+    import frames
+    encoder = frames.load_encoders(os.path.join(REPO_DIR, bridge.DBC_FILE), os.path.join(REPO_DIR, bridge.FRAME_CACHE_FILE))["Battery_actual_values_UIt"]
+    name, start_bit, length, is_signed, scale, offset, *_ = next(s for s in encoder.signals if s[0] == "Battery_voltage")
+    listener.set_filters([{"can_id": encoder.frame_id, "can_mask": 0x7FF, "extended": False}])
+
+    def frame_voltage(msg):
+        raw = int.from_bytes(msg.data[start_bit // 8:(start_bit + length) // 8], "little", signed=is_signed)
+        return round(raw * scale + offset, 2)
+
+    bridge_env = dict(env, BRIDGE_CAN_INTERFACE=args.can_interface, BRIDGE_API_URL=f"http://127.0.0.1:{args.port}/api", BRIDGE_VALUE_SOURCE=args.value_source, METRICS_ENABLED="0")
+    api = start_process([sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"], env)
+    bridge_process = None
+    latencies, timeouts = [], 0
+    try:
+        wait_for_api(args.port, api)
+        bridge_process = start_process([sys.executable, "-c", "import bridge; bridge.main()"], bridge_env)
+
+        # Wait for the bridge to send the initial voltage
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            msg = listener.recv(timeout=1)
+            if msg is not None and frame_voltage(msg) == INITIAL_VALUES[1]:
+                break
+        else:
+            return {"skipped": "bridge did not start sending frames"}
+
+        for i in range(args.e2e_samples):
+            # A random delay, so that the changes land at every phase of the poll and CAN cycles
+            time.sleep(random.uniform(0, 1))
+            voltage = round(51.0 + (i % 2) + (i % 50) * 0.01, 2)
+            struct.pack_into("<f", values, 1 * 4, voltage)
+            changed = time.monotonic()
+            deadline = changed + args.e2e_timeout
+            while True:
+                msg = listener.recv(timeout=max(0.0, deadline - time.monotonic()))
+                if msg is None:
+                    timeouts += 1
+                    break
+                if frame_voltage(msg) == voltage:
+                    latencies.append(time.monotonic() - changed)
+                    break
+    finally:
+        stop_process(bridge_process)
+        stop_process(api)
+        listener.shutdown()
+    return {"value_source": args.value_source, "samples": len(latencies), "timeouts": timeouts, **latency_stats(latencies)}
+
+# --- Main ---
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency-us", type=int, default=2000, help="Latency of every fake bus call, in microseconds (default 2000)")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per API load run (default 5)")
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 10, 50], help="Comma separated client counts (default 1,10,50)")
+    parser.add_argument("--api-scenarios", type=lambda s: s.split(","), help="Comma separated API scenarios to run: polled_value, live_value, values_batch, values_packed, write_under_load (default all)")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the API started for the benchmark (default 8765)")
+    parser.add_argument("--can-interface", default="vcan0", help="SocketCAN interface for the end-to-end benchmark (default vcan0)")
+    parser.add_argument("--value-source", default="stream", help="Bridge value source for the end-to-end benchmark (default stream)")
+    parser.add_argument("--e2e-samples", type=int, default=20, help="Value changes timed end to end (default 20)")
+    parser.add_argument("--e2e-timeout", type=float, default=5.0, help="Seconds to wait for each changed frame (default 5)")
+    parser.add_argument("--only", choices=["api", "decode", "encode", "bridge_tick", "end_to_end"], action="append", help="Run only these benchmarks")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    selected = set(args.only or ["api", "decode", "encode", "bridge_tick", "end_to_end"])
+
+    library = build_fake_library()
+
+    # Bridge field values shared with the fake library in the API and bridge processes
+    values_file = tempfile.NamedTemporaryFile(prefix="fake_masterbus_values_", suffix=".bin")
+    values_file.write(bytes(256 * 4))
+    values_file.flush()
+    values = mmap.mmap(values_file.fileno(), 256 * 4)
+    for field_id, value in INITIAL_VALUES.items():
+        struct.pack_into("<f", values, field_id * 4, value)
+
+    # Without a snapshot file, so that no run restores values or catalogs from an earlier one
+    env = dict(os.environ, MASTERBUS_LIBRARY=library, FAKE_MASTERBUS_LATENCY_US=str(args.latency_us), FAKE_MASTERBUS_VALUES=values_file.name, PYTHONPATH=REPO_DIR, MASTERBUS_SNAPSHOT_FILE="")
+
+    # This process only decodes, without bus latency
+    os.environ.update(MASTERBUS_LIBRARY=library, FAKE_MASTERBUS_LATENCY_US="0")
+    os.environ.pop("FAKE_MASTERBUS_VALUES", None)
+    sys.path.insert(0, REPO_DIR)
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "latency_us": args.latency_us,
+            "duration": args.duration,
+            "metrics_enabled": os.environ.get("METRICS_ENABLED", "1") != "0",
+        },
+    }
+    try:
+        if "api" in selected:
+            results["api"] = bench_api(args, env)
+        if "decode" in selected:
+            results["decode"] = bench_decode(args)
+        if "encode" in selected:
+            results["encode"] = bench_encode(args)
+        if "bridge_tick" in selected:
+            results["bridge_tick"] = bench_bridge_tick(args, env)
+        if "end_to_end" in selected:
+            results["end_to_end"] = bench_end_to_end(args, env, values)
+    finally:
+        values.close()
+        values_file.close()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
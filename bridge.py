@@ -1,62 +1,736 @@
 
 import requests
-import cantools
 import can
+import frames
+import metrics
+import packed
+import recording
+from scheduling import next_deadline
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+import json
+import math
+import os
+import threading
 import time
 import sys
 
 # --- Configuration ---
-API_BASE_URL = "http://localhost:8000/api"
-CAN_INTERFACE = "can0"
+API_BASE_URL = os.environ.get("BRIDGE_API_URL", "http://localhost:8000/api")
+CAN_INTERFACE = os.environ.get("BRIDGE_CAN_INTERFACE", "can0") # Inverter side
 DBC_FILE = "pylon_CAN_210124.dbc"
+FRAME_CACHE_FILE = "pylon_CAN_210124.frames.json" # Compiled DBC encoders, rebuilt when the DBC changes
 BATTERY_DEVICE_ID = 7165674  # BAT 1 (Cluster) as per user's device list
 CHARGER_DEVICE_ID = 2667145  # As per user's request
 
+def parse_intervals(spec: str, key=str):
+    """Parses comma separated 'key:seconds' entries into a {key: seconds} dict."""
+    intervals = {}
+    for entry in filter(None, spec.replace(" ", "").split(",")):
+        name, seconds = entry.split(":")
+        intervals[key(name)] = float(seconds)
+    return intervals
+
+def parse_batteries(spec: str):
+    """Parses comma separated 'device_id' or 'device_id:capacity_ah' entries into a {device_id: capacity} dict."""
+    batteries = {}
+    for entry in filter(None, spec.replace(" ", "").split(",")):
+        device_id, _, capacity = entry.partition(":")
+        batteries[int(device_id)] = float(capacity) if capacity else 1.0
+    return batteries
+
+# Batteries and chargers combined into the single battery the inverter sees. A battery's
+# capacity weighs its state of charge; without capacities every battery weighs the same.
+BATTERIES = parse_batteries(os.environ.get("BRIDGE_BATTERIES", str(BATTERY_DEVICE_ID)))
+CHARGERS = [int(device_id) for device_id in os.environ.get("BRIDGE_CHARGERS", str(CHARGER_DEVICE_ID)).replace(" ", "").split(",") if device_id]
+
+# MasterBus field IDs read every tick from each battery and charger
+SOC_FIELD_ID = 0               # State of charge (%)
+VOLTAGE_FIELD_ID = 1           # Battery (V)
+BATTERY_CURRENT_FIELD_ID = 2   # Battery (A)
+TEMPERATURE_FIELD_ID = 5       # Battery (°C)
+CHARGER_CURRENT_FIELD_ID = 15  # Battery current (A) of a charger
+BATTERY_FIELD_IDS = [SOC_FIELD_ID, VOLTAGE_FIELD_ID, BATTERY_CURRENT_FIELD_ID, TEMPERATURE_FIELD_ID]
+
+# Every field read, as (device_id, field_id)
+FIELDS = [(device_id, field_id) for device_id in BATTERIES for field_id in BATTERY_FIELD_IDS] + [(device_id, CHARGER_CURRENT_FIELD_ID) for device_id in CHARGERS]
+
+# Where MasterBus values come from:
+#   "stream"    - subscribe to the API service's value stream (default)
+#   "http"      - poll the API service, each value at its POLL_INTERVALS interval
+#   "masterbus" - read libmasterbus in this process, each value at its POLL_INTERVALS interval, without the API service
+#   "mock"      - fixed MOCK_VALUES, for running without MasterBus
+#   "replay"    - the values recorded in BRIDGE_REPLAY_FILE, checking the frames sent against the recorded ones
+VALUE_SOURCE = os.environ.get("BRIDGE_VALUE_SOURCE", "stream")
+# python-can interface of the inverter side; "virtual" runs without a CAN bus. A replay defaults
+# to "virtual", so that it never sends recorded frames to the inverter unless asked to.
+CAN_BUSTYPE = os.environ.get("BRIDGE_CAN_BUSTYPE", "virtual" if VALUE_SOURCE == "replay" else "socketcan")
+# SocketCAN ports of the MasterBus, comma separated. Used by the "masterbus" value source.
+MASTERBUS_PORTS = [port for port in os.environ.get("MASTERBUS_PORTS", os.environ.get("MASTERBUS_PORT", "can1")).replace(" ", "").split(",") if port]
+
+# Float changes smaller than these are not streamed, by field ID; half the resolution of the CAN signals
+DEADBANDS = {
+    SOC_FIELD_ID: 0.05,
+    VOLTAGE_FIELD_ID: 0.005,
+    BATTERY_CURRENT_FIELD_ID: 0.05,
+    TEMPERATURE_FIELD_ID: 0.005,
+    CHARGER_CURRENT_FIELD_ID: 0.05,
+}
+STREAM_KEEPALIVE = 5 # Seconds between the keepalives with every value's read time sent by the API
+
+# Seconds between reads of each value by the "http", "masterbus" and "mock" value sources, by
+# field ID, on fixed deadlines. Slowly changing values are read less often. Overridden with
+# BRIDGE_POLL_INTERVALS as comma separated 'field_id:seconds' entries.
+POLL_INTERVALS = {
+    SOC_FIELD_ID: 5.0,
+    VOLTAGE_FIELD_ID: 1.0,
+    BATTERY_CURRENT_FIELD_ID: 1.0,
+    TEMPERATURE_FIELD_ID: 10.0,
+    CHARGER_CURRENT_FIELD_ID: 1.0,
+    **parse_intervals(os.environ.get("BRIDGE_POLL_INTERVALS", ""), int),
+}
+
+# Seconds between frames of each CAN message, by task name. Overridden with BRIDGE_CYCLE_TIMES
+# as comma separated 'message:seconds' entries. The alive counter advances once per alive cycle.
+CYCLE_TIMES = {
+    "alive": 1.0,
+    "soc": 1.0,
+    "uit": 1.0,
+    "limits": 1.0,
+    "req": 1.0,
+    "err": 1.0,
+    "man": 1.0,
+    **parse_intervals(os.environ.get("BRIDGE_CYCLE_TIMES", "")),
+}
+
+# Longest time between ticks, so that the alive counter keeps advancing while no value is due
+TICK_INTERVAL = CYCLE_TIMES["alive"]
+
+# Seconds a tick waits for the "http" value source's fetch before using the last known values
+FETCH_DEADLINE = float(os.environ.get("BRIDGE_FETCH_DEADLINE", "0.8"))
+# Seconds the bridge waits at startup for the API service to have the values of FIELDS, before
+# starting without them. Only the "stream" and "http" value sources wait.
+READY_TIMEOUT = float(os.environ.get("BRIDGE_READY_TIMEOUT", "30"))
+# Seconds a last known value is used for after its next read was due; after that it counts as missing
+MAX_VALUE_AGE = float(os.environ.get("BRIDGE_MAX_VALUE_AGE", "10"))
+
+# Binary log of the values read and the frames sent every tick, rotated once it reaches
+# BRIDGE_RECORD_MAX_BYTES with BRIDGE_RECORD_KEEP older files kept. Not recorded when unset.
+RECORD_FILE = os.environ.get("BRIDGE_RECORD_FILE")
+RECORD_MAX_BYTES = int(os.environ.get("BRIDGE_RECORD_MAX_BYTES", str(16 * 1024 * 1024)))
+RECORD_KEEP = int(os.environ.get("BRIDGE_RECORD_KEEP", "5"))
+# Recording played by the "replay" value source, with its rotated files, and how many times
+# faster than it was recorded; 0 plays it as fast as possible
+REPLAY_FILE = os.environ.get("BRIDGE_REPLAY_FILE", "bridge.mbr")
+REPLAY_SPEED = float(os.environ.get("BRIDGE_REPLAY_SPEED", "0"))
+
+# Port serving the bridge's /metrics, unless metrics are disabled with METRICS_ENABLED=0
+METRICS_PORT = int(os.environ.get("BRIDGE_METRICS_PORT", "9101"))
+# Whether the bridge listens to its own frames on the CAN interface to measure their jitter,
+# while metrics are enabled. Set BRIDGE_FRAME_MONITOR=0 to not open the extra CAN socket.
+FRAME_MONITOR = os.environ.get("BRIDGE_FRAME_MONITOR", "1") != "0"
+
+# Values of the "mock" value source, by field ID
+MOCK_VALUES = {
+    SOC_FIELD_ID: 80.0,
+    VOLTAGE_FIELD_ID: 53.0,
+    BATTERY_CURRENT_FIELD_ID: -3.0,
+    TEMPERATURE_FIELD_ID: 25.0,
+    CHARGER_CURRENT_FIELD_ID: 0.0,
+}
+
+# --- Metrics ---
+
+TICK_PHASE_SECONDS = metrics.Histogram("bridge_tick_phase_seconds", "Time each bridge tick spent fetching values, encoding frames and handing them to the CAN tasks.", ["phase"])
+API_FETCH_SECONDS = metrics.Histogram("bridge_api_fetch_seconds", "Duration of value requests to the MasterBus API, including ones that missed the tick's deadline.")
+API_FETCH_ERRORS = metrics.Counter("bridge_api_fetch_errors_total", "Value requests to the MasterBus API that failed.")
+SIGNAL_AGE = metrics.Gauge("bridge_signal_age_seconds", "Seconds since each MasterBus value was last confirmed, +Inf if it never was.", ["device_id", "field_id"])
+FRAME_UPDATES = metrics.Counter("bridge_frame_updates_total", "Payloads handed to a periodic CAN task (applied) or left alone as unchanged (skipped).", ["message", "result"])
+CAN_ERRORS = metrics.Counter("bridge_can_errors_total", "Errors updating a periodic CAN task.", ["message"])
+TASK_RUNNING = metrics.Gauge("bridge_task_running", "1 while a periodic CAN task is sending, 0 once it stopped.", ["message"])
+ALIVE_LATENESS = metrics.Histogram("bridge_alive_update_lateness_seconds", "How late the alive counter was advanced relative to its schedule.")
+POLL_LATENESS = metrics.Histogram("bridge_poll_lateness_seconds", "How late each scheduled read of a MasterBus value started relative to its deadline.", ["device_id", "field_id"])
+SIGNAL_READS = metrics.Counter("bridge_signal_reads_total", "Scheduled reads of each MasterBus value.", ["device_id", "field_id"])
+FRAME_JITTER = metrics.Histogram("bridge_frame_jitter_seconds", "How far the time between consecutive frames of each message on the CAN interface deviated from its cycle time.", ["message"])
+
+def task_running(task):
+    """Whether a periodic task is still sending. Kernel (BCM) tasks have no thread that could die."""
+    if getattr(task, "stopped", False):
+        return False
+    thread = getattr(task, "thread", None)
+    return thread is None or thread.is_alive()
+
+# --- Scheduling ---
+
+class DeadlineSchedule:
+    """Absolute monotonic deadlines of jobs repeating at their own interval, all first due when first waited for."""
+    def __init__(self, intervals):
+        self.intervals = dict(intervals)
+        self.deadlines = None
+
+    def wait(self):
+        """
+        Sleeps until the earliest deadline, then returns the jobs due with how many seconds
+        late each is, and schedules their next runs.
+        """
+        if self.deadlines is None:
+            self.deadlines = dict.fromkeys(self.intervals, time.monotonic())
+        time.sleep(max(0.0, min(self.deadlines.values()) - time.monotonic()))
+        now = time.monotonic()
+        due = {}
+        for key, deadline in self.deadlines.items():
+            if deadline <= now:
+                due[key] = now - deadline
+                self.deadlines[key] = next_deadline(deadline, self.intervals[key], now)
+        return due
+
 # --- Main Application ---
 
-def get_masterbus_value(device_id, field_id):
-    """Fetches a single value from the MasterBus API."""
+def get_masterbus_values(session, packer, timeout=5):
+    """
+    Fetches the values of a packed.PackedValues' fields from the MasterBus API in a single
+    request, as packed floats. Returns a dict keyed by (device_id, field_id); fields that
+    could not be read are None.
+    """
+    start = time.perf_counter()
     try:
-        # Using a timeout for the request
-        response = requests.get(f"{API_BASE_URL}/devices/{device_id}/fields/{field_id}/value", timeout=5)
+        response = session.get(f"{API_BASE_URL}/values/packed", params=[("fields", f"{d}:{f}") for d, f in packer.fields], timeout=timeout)
         response.raise_for_status()
-        data = response.json()
-        return data.get("value")
-    except requests.exceptions.RequestException as e:
-        # Don't print endlessly if the API is down, just return None
-        return None
+        _, values = packer.unpack(response.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # Don't print endlessly if the API is down, just return None for every field
+        API_FETCH_ERRORS.inc()
+        return {field: None for field in packer.fields}
+    finally:
+        API_FETCH_SECONDS.observe(time.perf_counter() - start)
+    return {field: value if value == value else None for field, value in zip(packer.fields, values)}
+
+def wait_for_api(fields, timeout=READY_TIMEOUT):
+    """Polls the API service's readiness probe for the fields every 0.1 s, returning whether it got ready in time."""
+    deadline = time.monotonic() + timeout
+    params = [("fields", f"{d}:{f}") for d, f in fields]
+    with requests.Session() as session:
+        while True:
+            try:
+                if session.get(f"{API_BASE_URL}/ready", params=params, timeout=1).status_code == 200:
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
+# --- Value Sources ---
+# A value source provides the MasterBus values the bridge sends to the inverter. Its read()
+# returns a dict keyed by (device_id, field_id), with None for values that are unavailable.
+# read() blocks until values may have changed, for at most about TICK_INTERVAL.
+
+# Key of the TICK_INTERVAL job in a polling source's schedule
+TICK = "tick"
+
+@lru_cache(maxsize=64)
+def packer(fields):
+    return packed.PackedValues(fields)
+
+class ValueSource:
+    """
+    Keeps the last known value of every field with the time it was last confirmed. A field
+    that fails to read keeps its last known value until MAX_VALUE_AGE seconds after its next
+    read was due. Sources pass the interval every field is read at; polling sources read each
+    field on its own fixed deadlines through due_fields().
+    """
+    def __init__(self, fields, intervals=None):
+        self.fields = fields
+        self.values = {field: None for field in fields}
+        self.confirmed = {field: None for field in fields}
+        self.intervals = intervals or {}
+        self.max_ages = {field: MAX_VALUE_AGE + self.intervals.get(field, 0.0) for field in fields}
+        self.schedule = None
+        # Seconds the last read() spent fetching values, not counting the wait for the next poll
+        self.fetch_seconds = 0.0
+        # Monotonic time the alive counter is next due, set by the main loop before each read().
+        # Sources woken up by value changes return by then; polling sources follow their own schedule.
+        self.wake_deadline = None
+
+    def due_fields(self):
+        """Waits for the schedule's next deadline, returning the fields due to be read then."""
+        if self.schedule is None:
+            self.schedule = DeadlineSchedule({**self.intervals, TICK: TICK_INTERVAL})
+        due = self.schedule.wait()
+        fields = [field for field in due if field != TICK]
+        for field in fields:
+            POLL_LATENESS.observe(due[field], *field)
+            SIGNAL_READS.inc(*field)
+        return fields
+
+    def update(self, field, value, confirmed=None):
+        """Stores a field's value, read at the monotonic time `confirmed` (default: now)."""
+        self.values[field] = value
+        self.confirmed[field] = time.monotonic() if confirmed is None else confirmed
+
+    def confirm(self, field, confirmed):
+        """Records that a field's value was still current at the monotonic time `confirmed`."""
+        if field in self.confirmed and self.confirmed[field] is not None:
+            self.confirmed[field] = max(self.confirmed[field], confirmed)
+
+    def ages(self):
+        """Seconds since each field's value was last confirmed, None if it never was."""
+        now = time.monotonic()
+        return {field: now - confirmed if confirmed is not None else None for field, confirmed in self.confirmed.items()}
+
+    def current_values(self):
+        return {field: self.values[field] if age is not None and age <= self.max_ages[field] else None for field, age in self.ages().items()}
+
+    def clock(self):
+        """Monotonic time of the values last read, which the alive counter is scheduled by."""
+        return time.monotonic()
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class HttpPollSource(ValueSource):
+    """
+    Fetches the fields due from the MasterBus API in one request per tick, over a persistent
+    connection, each field at its own interval. A fetch that misses the `deadline` (seconds)
+    doesn't hold up the tick: it is left to finish in the background and the fields keep
+    their last known values.
+    """
+    def __init__(self, fields, intervals, deadline=FETCH_DEADLINE):
+        super().__init__(fields, intervals)
+        self.deadline = deadline
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-fetch")
+        self.pending = None
+
+    def collect(self, fetch):
+        for field, value in fetch.result().items():
+            if value is not None:
+                self.update(field, value)
+
+    def read(self):
+        fields = self.due_fields()
+        start = time.monotonic()
+        deadline = start + self.deadline
+
+        # A fetch that missed an earlier deadline is collected once done, or waited for
+        # instead of piling up another request behind it
+        if self.pending is not None and self.pending.done():
+            self.collect(self.pending)
+            self.pending = None
+        if self.pending is None and fields:
+            self.pending = self.executor.submit(get_masterbus_values, self.session, packer(tuple(fields)))
+        if self.pending is not None:
+            try:
+                self.pending.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                self.fetch_seconds = time.monotonic() - start
+                return self.current_values()
+            self.collect(self.pending)
+            self.pending = None
+        self.fetch_seconds = time.monotonic() - start
+        return self.current_values()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+def api_read_time(timestamp):
+    """Monotonic time of an API read timestamp (wall clock time), no later than now."""
+    return time.monotonic() - max(0.0, time.time() - timestamp)
+
+class HttpStreamSource(ValueSource):
+    """
+    Follows the MasterBus API's value stream, returning as soon as a value changed. A value is
+    confirmed at the time the API read it, as given by its event and by the keepalive events
+    listing every field's last read time, so a field the API can't read ages like when polled.
+    The intervals are those the API polls the fields at; read times reach the bridge up to
+    STREAM_KEEPALIVE seconds later, which the fields' maximum ages allow for.
+    """
+    def __init__(self, fields, intervals):
+        super().__init__(fields, intervals)
+        self.max_ages = {field: max_age + STREAM_KEEPALIVE for field, max_age in self.max_ages.items()}
+        self.updated = threading.Event()
+        self.session = requests.Session()
+        threading.Thread(target=self.follow_stream, daemon=True).start()
+
+    def follow_stream(self):
+        """Runs forever, reconnecting when the stream drops."""
+        params = [("fields", f"{d}:{f}:{DEADBANDS.get(f, 0)}") for d, f in self.fields]
+        params.append(("keepalive", STREAM_KEEPALIVE))
+        while True:
+            try:
+                # The read timeout catches a dead stream, as the API sends at least a keepalive
+                with self.session.get(f"{API_BASE_URL}/stream", params=params, stream=True, timeout=(5, STREAM_KEEPALIVE * 2)) as response:
+                    response.raise_for_status()
+                    event = None
+                    for line in response.iter_lines():
+                        if line.startswith(b"event:"):
+                            event = line[6:].strip()
+                        elif line.startswith(b"data:") and event == b"keepalive":
+                            for device_id, field_id, timestamp in json.loads(line[5:]):
+                                self.confirm((device_id, field_id), api_read_time(timestamp))
+                        elif line.startswith(b"data:"):
+                            item = json.loads(line[5:])
+                            self.update((item["device_id"], item["field_id"]), item.get("value"), api_read_time(item["timestamp"]))
+                            self.updated.set()
+                        elif not line:
+                            event = None
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(1)
+
+    def read(self):
+        # Wake up as soon as the stream delivers a change, or when the alive counter is next due. The
+        # deadline is absolute, so the alive updates don't drift by however long each tick took.
+        # While the alive counter is held back, e.g. without values, the deadline has passed already.
+        now = time.monotonic()
+        due_in = self.wake_deadline - now if self.wake_deadline is not None else 0.0
+        self.updated.wait(timeout=due_in if due_in > 0 else TICK_INTERVAL)
+        self.updated.clear()
+        return self.current_values()
+
+class MasterBusSource(ValueSource):
+    """
+    Reads the fields due straight from libmasterbus in this process, each field at its own
+    interval. Each port has its own context and thread, so the ports are read in parallel
+    (ctypes releases the GIL during library calls). Fields are read from the port their device is on; while a device
+    hasn't been found on any port, the ports' device lists are checked again every 30 seconds.
+    """
+    def __init__(self, fields, intervals, ports):
+        super().__init__(fields, intervals)
+        # Imported here, as loading libmasterbus.so is only needed for this source
+        import masterbus
+        self.masterbus = masterbus
+        self.ports = ports
+        self.executors = {port: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"masterbus-{port}") for port in ports}
+        self.contexts = {}
+        try:
+            for port in ports:
+                self.contexts[port] = self.executors[port].submit(masterbus.connect_socketcan, port).result()
+        except masterbus.MasterBusError:
+            self.close()
+            raise
+        self.device_ports = {}
+        self.next_device_check = time.monotonic()
+
+    def locate_devices(self):
+        """Finds the port of every device; devices not found are read from the first port for now."""
+        self.next_device_check = time.monotonic() + 30
+        for port in self.ports:
+            try:
+                for device_id in self.executors[port].submit(self.masterbus.read_devices, self.contexts[port]).result():
+                    self.device_ports[device_id] = port
+            except self.masterbus.MasterBusError:
+                pass
+
+    def read_fields(self, port, fields):
+        """Reads fields on the port's thread, returning the values that could be read."""
+        values = {}
+        for device_id, field_id in fields:
+            try:
+                values[(device_id, field_id)] = self.masterbus.read_field_value(self.contexts[port], device_id, field_id)["value"]
+            except self.masterbus.MasterBusError:
+                pass
+        return values
+
+    def read(self):
+        fields = self.due_fields()
+        start = time.monotonic()
+        if time.monotonic() >= self.next_device_check and any(device_id not in self.device_ports for device_id, _ in self.fields):
+            self.locate_devices()
+        port_fields = {}
+        for field in fields:
+            port_fields.setdefault(self.device_ports.get(field[0], self.ports[0]), []).append(field)
+        reads = [self.executors[port].submit(self.read_fields, port, fields) for port, fields in port_fields.items()]
+        for read in reads:
+            for field, value in read.result().items():
+                self.update(field, value)
+        self.fetch_seconds = time.monotonic() - start
+        return self.current_values()
+
+    def close(self):
+        for port, ctx in self.contexts.items():
+            self.executors[port].submit(self.masterbus.libmasterbus.masterbus_free, ctx).result()
+        for executor in self.executors.values():
+            executor.shutdown()
+
+class MockSource(ValueSource):
+    """Returns MOCK_VALUES, each field confirmed at its own interval."""
+    def __init__(self, fields, intervals):
+        super().__init__(fields, intervals)
+
+    def read(self):
+        for field in self.due_fields():
+            self.update(field, MOCK_VALUES.get(field[1]))
+        return self.current_values()
+
+class ReplaySource(ValueSource):
+    """
+    Plays back the ticks of a recording made with BRIDGE_RECORD_FILE, on the recording's clock,
+    `speed` times faster than recorded or as fast as possible with a speed of 0. It also stands
+    in for the recorder, comparing every frame sent with the one recorded in the same tick.
+    read() raises recording.ReplayFinished after the last tick. Where the replay picks up a run,
+    at its start or where a file starts in the middle of one, `sending` holds the payloads the
+    CAN tasks were already sending and `alive_deadline` when the alive counter was next due,
+    for the bridge to continue from; they are None for the other ticks.
+    """
+    def __init__(self, fields, path, speed=0.0):
+        super().__init__(fields)
+        paths = recording.log_files(path)
+        if not paths:
+            raise FileNotFoundError(f"No recording at '{path}'")
+        self.ticks = recording.read_ticks(paths)
+        self.speed = speed
+        self.now = None
+        self.start = None
+        self.sending = None
+        self.alive_deadline = None
+        self.expected = []
+        self.tick_count = 0
+        self.matching = 0
+        self.differing = 0
+
+    def clock(self):
+        return self.now
+
+    def read(self):
+        # Recorded frames the last tick didn't send
+        self.differing += len(self.expected)
+        self.expected = []
+        try:
+            timestamp, values, frames, alive_deadline, self.sending = next(self.ticks)
+        except StopIteration:
+            raise recording.ReplayFinished from None
+        self.alive_deadline = alive_deadline if self.sending is not None else None
+        if self.speed > 0:
+            # The time between runs, while the bridge was down, is skipped
+            if self.start is None or self.sending is not None:
+                self.start = (time.monotonic(), timestamp)
+            time.sleep(max(0.0, self.start[0] + (timestamp - self.start[1]) / self.speed - time.monotonic()))
+        self.now = timestamp
+        self.expected = frames[::-1]
+        self.tick_count += 1
+        for field, value in values.items():
+            if field in self.values and value is not None:
+                self.update(field, value)
+        return {field: values.get(field) for field in self.fields}
+
+    # The recorder interface
+    def tick(self, timestamp, values, alive_deadline=math.nan):
+        pass
+
+    def frame(self, frame_id, data):
+        if self.expected and self.expected.pop() == (frame_id, bytes(data)):
+            self.matching += 1
+        else:
+            self.differing += 1
+
+    def flush(self):
+        pass
+
+# --- Battery Aggregation ---
+
+def clamp_soc(soc):
+    """Rounds a state of charge to a whole percentage between 0 and 100."""
+    return int(max(0, min(100, round(soc))))
+
+def battery_limits(soc):
+    """Returns the (charge, discharge) current limits in A for a battery's state of charge."""
+    if soc >= 98:
+        return 20.0, -100.0
+    if soc <= 15:
+        return 100.0, -20.0
+    return 100.0, -100.0
+
+def aggregate_values(values):
+    """
+    Combines the BATTERIES and CHARGERS into the single battery reported to the inverter.
+    Currents are summed and the state of charge is weighted by capacity. The voltage is the
+    average, the temperature the highest, and each current limit the smallest of any
+    battery. Only chargers delivering more than 1 A count. Returns None while any battery
+    value is missing.
+    """
+    total_capacity = soc = voltage = current = 0.0
+    temperature = -math.inf
+    charge_limit, discharge_limit = math.inf, -math.inf
+    for device_id, capacity in BATTERIES.items():
+        battery = [values[(device_id, field_id)] for field_id in BATTERY_FIELD_IDS]
+        if any(value is None for value in battery):
+            return None
+        battery_soc, battery_voltage, battery_current, battery_temperature = battery
+        total_capacity += capacity
+        soc += battery_soc * capacity
+        voltage += battery_voltage
+        current += battery_current
+        temperature = max(temperature, battery_temperature)
+        battery_charge_limit, battery_discharge_limit = battery_limits(clamp_soc(battery_soc))
+        charge_limit = min(charge_limit, battery_charge_limit)
+        discharge_limit = max(discharge_limit, battery_discharge_limit)
+
+    charger_currents = [values[(device_id, CHARGER_CURRENT_FIELD_ID)] for device_id in CHARGERS]
+    return {
+        "soc": soc / total_capacity,
+        "voltage": voltage / len(BATTERIES),
+        "current": current,
+        "temperature": temperature,
+        "charger_current": sum(value for value in charger_currents if value is not None and value > 1.0),
+        "charge_limit": charge_limit,
+        "discharge_limit": discharge_limit,
+    }
+
+# --- CAN Frame Updates ---
+
+# Per periodic task: how many new payloads were handed to it ("applied"), and how many
+# were skipped because the task was already sending exactly that payload ("skipped")
+frame_updates = {}
+
+def update_periodic_message(bus, tasks, name, msg, encoder, signals, timings, recorder=None):
+    """
+    Encodes a message and hands the new payload to its periodic CAN task, unless that payload
+    is already being sent. The task is started with its first payload, which sends that right
+    away instead of on the next period of a task started empty. The time spent is added to
+    timings["encode"] and timings["modify_data"]. New payloads are also passed to the recorder, if any.
+    """
+    start = time.perf_counter()
+    data = encoder.encode(signals)
+    encoded = time.perf_counter()
+    timings["encode"] += encoded - start
+
+    counts = frame_updates.setdefault(name, {"applied": 0, "skipped": 0})
+    if msg.data == data:
+        counts["skipped"] += 1
+        FRAME_UPDATES.inc(name, "skipped")
+        return
+    previous = msg.data
+    msg.data = data
+    try:
+        if name in tasks:
+            tasks[name].modify_data(msg)
+        else:
+            tasks[name] = bus.send_periodic(msg, CYCLE_TIMES[name])
+    except Exception as e:
+        # Not handed over, so that the same payload is tried again instead of skipped as already sent
+        msg.data = previous
+        if isinstance(e, can.CanError):
+            CAN_ERRORS.inc(name)
+        raise
+    finally:
+        timings["modify_data"] += time.perf_counter() - encoded
+    counts["applied"] += 1
+    FRAME_UPDATES.inc(name, "applied")
+    if recorder:
+        recorder.frame(msg.arbitration_id, data)
+
+class FrameMonitor:
+    """
+    Listens on its own socket of the CAN interface to the frames of the given {arbitration_id:
+    name} messages and observes how far the time between consecutive frames of each deviates
+    from its cycle time, as sent by the periodic tasks rather than as scheduled.
+    """
+    def __init__(self, messages):
+        self.messages = messages
+        self.last_seen = {}
+        self.bus = can.interface.Bus(channel=CAN_INTERFACE, interface=CAN_BUSTYPE,
+                                     can_filters=[{"can_id": frame_id, "can_mask": 0x7FF, "extended": False} for frame_id in messages])
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="frame-monitor", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                msg = self.bus.recv(timeout=0.5)
+            except can.CanError:
+                continue
+            if msg is None or msg.arbitration_id not in self.messages:
+                continue
+            name = self.messages[msg.arbitration_id]
+            last = self.last_seen.get(name)
+            self.last_seen[name] = msg.timestamp
+            if last is not None:
+                FRAME_JITTER.observe(abs(msg.timestamp - last - CYCLE_TIMES[name]), name)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(timeout=2)
+        self.bus.shutdown()
+
+def create_value_source(name, fields):
+    intervals = {field: POLL_INTERVALS.get(field[1], TICK_INTERVAL) for field in fields}
+    if name == "stream": return HttpStreamSource(fields, intervals)
+    if name == "http": return HttpPollSource(fields, intervals)
+    if name == "masterbus": return MasterBusSource(fields, intervals, MASTERBUS_PORTS)
+    if name == "mock": return MockSource(fields, intervals)
+    if name == "replay": return ReplaySource(fields, REPLAY_FILE, REPLAY_SPEED)
+    raise ValueError(f"Unknown value source '{name}', expected one of: stream, http, masterbus, mock, replay")
 
 def main():
     """
     Main loop to fetch data from MasterBus API and send it to the CAN bus.
     """
-    # Load the DBC file
+    # Load the message encoders compiled from the DBC file
     try:
-        db = cantools.database.load_file(DBC_FILE)
+        encoders = frames.load_encoders(DBC_FILE, FRAME_CACHE_FILE)
     except FileNotFoundError:
         print(f"Error: DBC file not found at '{DBC_FILE}'", file=sys.stderr)
         sys.exit(1)
 
     # Get message definitions from DBC
-    network_alive_msg_def = db.get_message_by_name('Network_alive_msg')
-    soc_soh_msg_def = db.get_message_by_name('Battery_SoC_SoH')
-    uit_msg_def = db.get_message_by_name('Battery_actual_values_UIt')
-    limits_msg_def = db.get_message_by_name('Battery_limits')
-    req_msg_def = db.get_message_by_name('Battery_Request')
-    err_warn_msg_def = db.get_message_by_name('Battery_Error_Warnings')
-    man_msg_def = db.get_message_by_name('Battery_Manufacturer')
+    network_alive_msg_def = encoders['Network_alive_msg']
+    soc_soh_msg_def = encoders['Battery_SoC_SoH']
+    uit_msg_def = encoders['Battery_actual_values_UIt']
+    limits_msg_def = encoders['Battery_limits']
+    req_msg_def = encoders['Battery_Request']
+    err_warn_msg_def = encoders['Battery_Error_Warnings']
+    man_msg_def = encoders['Battery_Manufacturer']
     
     # Initialize CAN bus
     bus = None
     try:
         # Corrected 'bustype' to 'interface' to fix deprecation warning
-        bus = can.interface.Bus(channel=CAN_INTERFACE, interface='socketcan')
+        bus = can.interface.Bus(channel=CAN_INTERFACE, interface=CAN_BUSTYPE)
         print(f"Successfully connected to CAN bus '{CAN_INTERFACE}'.")
     except Exception as e:
         print(f"Error initializing CAN bus '{CAN_INTERFACE}': {e}", file=sys.stderr)
         sys.exit(1)
 
-    print("Starting data bridge...")
+    # Wait for the API service to have values, instead of connecting to it while it starts
+    if VALUE_SOURCE in ("stream", "http"):
+        print("Waiting for the API service to be ready...")
+        if not wait_for_api(FIELDS):
+            print(f"Warning: the API service is not ready after {READY_TIMEOUT:g}s, starting anyway.", file=sys.stderr)
+
+    # Initialize the value source
+    try:
+        source = create_value_source(VALUE_SOURCE, FIELDS)
+    except Exception as e:
+        print(f"Error initializing '{VALUE_SOURCE}' value source: {e}", file=sys.stderr)
+        bus.shutdown()
+        sys.exit(1)
+
+    # A replay checks the frames sent instead of recording them, and skips the per tick output
+    replaying = isinstance(source, ReplaySource)
+    recorder = None
+    if replaying:
+        recorder = source
+    elif RECORD_FILE:
+        try:
+            recorder = recording.Recorder(RECORD_FILE, RECORD_MAX_BYTES, RECORD_KEEP)
+            print(f"Recording to '{RECORD_FILE}'.")
+        except OSError as e:
+            print(f"Warning: could not record to '{RECORD_FILE}': {e}", file=sys.stderr)
+
+    print(f"Starting data bridge with '{VALUE_SOURCE}' value source...")
+
+    if metrics.ENABLED:
+        try:
+            metrics.serve(METRICS_PORT)
+            print(f"Serving metrics on port {METRICS_PORT}.")
+        except OSError as e:
+            print(f"Warning: could not serve metrics on port {METRICS_PORT}: {e}", file=sys.stderr)
 
     # --- Setup Periodic CAN Messages ---
     # All messages must be created with is_extended_id=False for standard CAN IDs.
@@ -72,101 +746,130 @@ def main():
     # Message: Battery_Manufacturer (ID 862) - Static. Data must be 8 bytes.
     man_msg = can.Message(arbitration_id=man_msg_def.frame_id, data=b'PYLON\x00\x00\x00', is_extended_id=False)
 
-    # Messages to be updated in the loop - must also be initialized correctly.
+    # Messages to be updated in the loop, whose tasks start with their first payload
     alive_msg = can.Message(arbitration_id=network_alive_msg_def.frame_id, is_extended_id=False)
     soc_soh_msg = can.Message(arbitration_id=soc_soh_msg_def.frame_id, is_extended_id=False)
     uit_msg = can.Message(arbitration_id=uit_msg_def.frame_id, is_extended_id=False)
     limits_msg = can.Message(arbitration_id=limits_msg_def.frame_id, is_extended_id=False)
 
     tasks = {
-        'alive': bus.send_periodic(alive_msg, 1.0),
-        'soc': bus.send_periodic(soc_soh_msg, 1.0),
-        'uit': bus.send_periodic(uit_msg, 1.0),
-        'limits': bus.send_periodic(limits_msg, 1.0),
-        'req': bus.send_periodic(req_msg, 1.0),
-        'err': bus.send_periodic(err_warn_msg, 1.0),
-        'man': bus.send_periodic(man_msg, 1.0),
+        'req': bus.send_periodic(req_msg, CYCLE_TIMES['req']),
+        'err': bus.send_periodic(err_warn_msg, CYCLE_TIMES['err']),
+        'man': bus.send_periodic(man_msg, CYCLE_TIMES['man']),
     }
 
+    # Jitter of the frames actually on the bus, for the metrics
+    monitor = None
+    if metrics.ENABLED and FRAME_MONITOR and not replaying:
+        try:
+            monitor = FrameMonitor({
+                network_alive_msg_def.frame_id: 'alive', soc_soh_msg_def.frame_id: 'soc', uit_msg_def.frame_id: 'uit',
+                limits_msg_def.frame_id: 'limits', req_msg_def.frame_id: 'req', err_warn_msg_def.frame_id: 'err', man_msg_def.frame_id: 'man',
+            })
+        except Exception as e:
+            print(f"Warning: could not monitor frame jitter on '{CAN_INTERFACE}': {e}", file=sys.stderr)
+
     alive_counter = 0
+    next_alive_time = None
     last_api_success_time = time.time()
+    replay_start = time.monotonic()
 
     try:
         while True:
-            # 1. Fetch data from MasterBus API
-            # Battery Data
-            soc = get_masterbus_value(BATTERY_DEVICE_ID, 0) # State of charge (%)
-            voltage = get_masterbus_value(BATTERY_DEVICE_ID, 1) # Battery (V)
-            battery_current = get_masterbus_value(BATTERY_DEVICE_ID, 2) # Battery (A)
-            temperature = get_masterbus_value(BATTERY_DEVICE_ID, 5) # Battery (°C)
-            
-            # Charger Data
-            charger_current = get_masterbus_value(CHARGER_DEVICE_ID, 15) # Battery current (A)
+            # 1. Fetch data from the value source
+            source.wake_deadline = next_alive_time
+            values = source.read()
+            now = source.clock()
+            if replaying and source.sending is not None:
+                # Continue from where the recorded bridge was, as a recording may start in the middle of a run
+                for msg in (alive_msg, soc_soh_msg, uit_msg, limits_msg):
+                    msg.data = bytearray(source.sending.get(msg.arbitration_id, b""))
+                alive_counter = round(network_alive_msg_def.decode(alive_msg.data)['Alive_packet']) if alive_msg.data else 0
+                next_alive_time = source.alive_deadline
+            if next_alive_time is None:
+                # The alive deadlines start when the first tick was due, so that ticks fetching faster later still meet them
+                next_alive_time = now - source.fetch_seconds
+            timings = {"fetch": source.fetch_seconds, "encode": 0.0, "modify_data": 0.0}
+            if recorder:
+                # Writes out the previous tick's records, so at most one tick is lost on a crash
+                recorder.flush()
+                recorder.tick(now, values, next_alive_time)
 
-            if any(v is None for v in [soc, voltage, battery_current, temperature]):
+            for (device_id, field_id), age in source.ages().items():
+                SIGNAL_AGE.set(age if age is not None else math.inf, device_id, field_id)
+            for name, task in tasks.items():
+                TASK_RUNNING.set(1 if task_running(task) else 0, name)
+
+            # Battery and charger data, combined into a single battery
+            bank = aggregate_values(values)
+
+            if bank is None:
                 if time.time() - last_api_success_time > 5:
-                     print("API fetch failed for primary battery data. Check masterbus-fastapi service.", file=sys.stderr)
-                time.sleep(1)
+                     print(f"Fetching primary battery data from the '{VALUE_SOURCE}' value source failed. Check the MasterBus connection.", file=sys.stderr)
                 continue
             
             last_api_success_time = time.time()
 
             # 2. Process and sanitize data
-            soc = int(max(0, min(100, round(soc))))
-            voltage = round(voltage, 2)
-            battery_current = round(battery_current, 2)
-            temperature = round(temperature, 2)
+            soc = clamp_soc(bank["soc"])
+            voltage = round(bank["voltage"], 2)
+            battery_current = round(bank["current"], 2)
+            temperature = round(bank["temperature"], 2)
             
             # Adjust current based on charger state
             adjusted_current = battery_current
             log_charger_current = 0.0
-            if charger_current is not None and charger_current > 1.0:
-                charger_current = round(charger_current, 2)
+            if bank["charger_current"] > 0:
+                charger_current = round(bank["charger_current"], 2)
                 adjusted_current -= charger_current
                 log_charger_current = charger_current
 
             # 3. Update CAN message data
             
-            # Alive message
-            alive_counter = (alive_counter + 1) % 256
-            alive_msg.data = network_alive_msg_def.encode({'Alive_packet': alive_counter})
-            tasks['alive'].modify_data(alive_msg)
-            
+            # Alive message, counted once per alive cycle however often values change
+            alive_due = now >= next_alive_time
+            if alive_due:
+                ALIVE_LATENESS.observe(now - next_alive_time)
+                # Kept on fixed deadlines, as ticks arriving right on time would otherwise miss every other one
+                next_alive_time = next_deadline(next_alive_time, CYCLE_TIMES['alive'], now)
+                alive_counter = (alive_counter + 1) % 256
+                update_periodic_message(bus, tasks, 'alive', alive_msg, network_alive_msg_def, {'Alive_packet': alive_counter}, timings, recorder)
+
+            # The messages below are only handed to their periodic task when their payload changed
+
             # SoC/SoH message
-            soc_soh_msg.data = soc_soh_msg_def.encode({'SoC': soc, 'SoH': 100}) # Assume SoH 100%
-            tasks['soc'].modify_data(soc_soh_msg)
+            update_periodic_message(bus, tasks, 'soc', soc_soh_msg, soc_soh_msg_def, {'SoC': soc, 'SoH': 100}, timings, recorder) # Assume SoH 100%
 
             # Actual values message - USE ADJUSTED CURRENT
-            uit_msg.data = uit_msg_def.encode({
+            update_periodic_message(bus, tasks, 'uit', uit_msg, uit_msg_def, {
                 'Battery_voltage': voltage, 
                 'Battery_current': adjusted_current, 
                 'Battery_temperature': temperature
-            })
-            tasks['uit'].modify_data(uit_msg)
+            }, timings, recorder)
             
             # Dynamic battery limits
-            if soc >= 98:
-                charge_limit = 20.0
-                discharge_limit = -100.0
-            elif soc <= 15:
-                charge_limit = 100.0
-                discharge_limit = -20.0
-            else:
-                charge_limit = 100.0
-                discharge_limit = -100.0
-
-            limits_msg.data = limits_msg_def.encode({
+            charge_limit = bank["charge_limit"]
+            discharge_limit = bank["discharge_limit"]
+
+            update_periodic_message(bus, tasks, 'limits', limits_msg, limits_msg_def, {
                'Battery_discharge_current_limit' : discharge_limit,
                'Battery_charge_current_limit' : charge_limit,
                'Battery_charge_voltage' : 54.5,
                'Battery_discharge_voltage' : 48.0
-            })
-            tasks['limits'].modify_data(limits_msg)
+            }, timings, recorder)
 
-            print(f"SENT: Time={time.strftime('%H:%M:%S')}, SoC={soc}%, U={voltage:.2f}V, I={adjusted_current:.2f}A (Bat: {battery_current:.2f}A, Chg: {log_charger_current:.2f}A), T={temperature:.2f}°C")
+            for phase, seconds in timings.items():
+                TICK_PHASE_SECONDS.observe(seconds, phase)
 
-            time.sleep(1)
+            # Logged once per alive cycle, as the stream source wakes up on every value change
+            if replaying or not alive_due:
+                continue
+            applied = sum(counts["applied"] for counts in frame_updates.values())
+            skipped = sum(counts["skipped"] for counts in frame_updates.values())
+            print(f"SENT: Time={time.strftime('%H:%M:%S')}, SoC={soc}%, U={voltage:.2f}V, I={adjusted_current:.2f}A (Bat: {battery_current:.2f}A, Chg: {log_charger_current:.2f}A), T={temperature:.2f}°C, Frame updates applied/skipped: {applied}/{skipped}")
 
+    except recording.ReplayFinished:
+        print(f"Replayed {source.tick_count} ticks in {time.monotonic() - replay_start:.2f}s: {source.matching} frames as recorded, {source.differing} different or missing.")
     except KeyboardInterrupt:
         print("\nShutting down bridge...")
     except Exception as e:
@@ -176,13 +879,15 @@ def main():
         for task in tasks.values():
             if task:
                 task.stop()
+        if monitor:
+            monitor.close()
+        source.close()
+        if recorder and not replaying:
+            recorder.close()
         if bus:
             bus.shutdown()
         print("CAN bridge stopped.")
 
 
 if __name__ == "__main__":
-    # Wait a few seconds for the API to be ready
-    print("Bridge starting in 5 seconds...")
-    time.sleep(5)
     main()
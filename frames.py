@@ -0,0 +1,123 @@
+"""
+Precompiled encoders for the CAN messages of a DBC file.
+
+The signal layouts are compiled once into struct (or bit shift) packers producing the
+same bytes as cantools' Message.encode(), as checked by tests/test_frames.py. They are
+cached next to the DBC file, so a later start doesn't need to parse the DBC with cantools
+at all.
+"""
+import hashlib
+import json
+import os
+import struct
+
+# Struct format characters for byte aligned little-endian signals, by length in bits
+STRUCT_FORMATS = {8: "b", 16: "h", 32: "i", 64: "q"}
+
+class FrameEncoder:
+    """
+    Encodes one message from a {signal name: value} dict, like cantools' Message.encode().
+    Signals are (name, start, length, is_signed, scale, offset, minimum, maximum) tuples
+    of little-endian integer signals.
+    """
+    def __init__(self, name, frame_id, length, signals):
+        self.name = name
+        self.frame_id = frame_id
+        self.length = length
+        self.signals = sorted(signals, key=lambda signal: signal[1])
+        # Scaled value limits, with the same tolerance cantools allows for rounding
+        self._conversions = [
+            (name, scale, offset, minimum - abs(scale) * 1e-6 if minimum is not None else None, maximum + abs(scale) * 1e-6 if maximum is not None else None)
+            for name, start, length, is_signed, scale, offset, minimum, maximum in self.signals
+        ]
+        self._struct = self._compile_struct()
+        self._bits = [(start, length, is_signed) for name, start, length, is_signed, *_ in self.signals]
+
+    def _compile_struct(self):
+        """Returns a struct.Struct packing all signals at once, or None if they are not byte aligned."""
+        fmt, position = "<", 0
+        for name, start, length, is_signed, *_ in self.signals:
+            if start % 8 or length not in STRUCT_FORMATS or start < position:
+                return None
+            fmt += "x" * ((start - position) // 8)
+            fmt += STRUCT_FORMATS[length] if is_signed else STRUCT_FORMATS[length].upper()
+            position = start + length
+        fmt += "x" * (self.length - position // 8)
+        return struct.Struct(fmt)
+
+    def encode(self, data):
+        raw_values = []
+        for name, scale, offset, minimum, maximum in self._conversions:
+            value = data[name]
+            if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+                raise ValueError(f'Signal "{name}" value {value} is out of range in message "{self.name}"')
+            raw_values.append(round((value - offset) / scale))
+
+        if self._struct:
+            try:
+                return self._struct.pack(*raw_values)
+            except struct.error:
+                raise ValueError(f'Raw values {raw_values} do not fit the signals of message "{self.name}"') from None
+
+        frame = 0
+        for raw, (start, length, is_signed) in zip(raw_values, self._bits):
+            low, high = (-(1 << (length - 1)), 1 << (length - 1)) if is_signed else (0, 1 << length)
+            if not low <= raw < high:
+                raise ValueError(f'Raw value {raw} does not fit in {length} bits in message "{self.name}"')
+            frame |= (raw & ((1 << length) - 1)) << start
+        return frame.to_bytes(self.length, "little")
+
+    def decode(self, data):
+        """Decodes a payload back into a {signal name: value} dict."""
+        frame = int.from_bytes(data, "little")
+        values = {}
+        for name, start, length, is_signed, scale, offset, *_ in self.signals:
+            raw = (frame >> start) & ((1 << length) - 1)
+            if is_signed and raw >> (length - 1):
+                raw -= 1 << length
+            values[name] = raw * scale + offset
+        return values
+
+def compile_layouts(db):
+    """Extracts the signal layouts of every message in a cantools database."""
+    layouts = {}
+    for message in db.messages:
+        signals = []
+        for signal in message.signals:
+            if signal.byte_order != "little_endian" or signal.is_float or signal.is_multiplexer or signal.multiplexer_ids or signal.choices:
+                raise ValueError(f'Signal "{signal.name}" of message "{message.name}" is not a plain little-endian integer signal')
+            signals.append([signal.name, signal.start, signal.length, signal.is_signed, signal.scale, signal.offset, signal.minimum, signal.maximum])
+        layouts[message.name] = {"frame_id": message.frame_id, "length": message.length, "signals": signals}
+    return layouts
+
+def load_encoders(dbc_file, cache_file):
+    """
+    Returns a {message name: FrameEncoder} dict for the DBC file. The layouts are read from
+    cache_file when it was compiled from the same DBC contents; otherwise the DBC is parsed
+    with cantools and the cache is rewritten.
+    """
+    with open(dbc_file, "rb") as f:
+        dbc_hash = hashlib.sha256(f.read()).hexdigest()
+
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache["dbc_sha256"] == dbc_hash:
+            return {name: FrameEncoder(name, **layout) for name, layout in cache["messages"].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # Imported here, as cantools is only needed when the cache is missing or stale
+    import cantools
+    db = cantools.database.load_file(dbc_file)
+    layouts = compile_layouts(db)
+    encoders = {name: FrameEncoder(name, **layout) for name, layout in layouts.items()}
+
+    # Written through a temporary file, so an interrupted write never leaves a truncated cache
+    try:
+        with open(f"{cache_file}.tmp", "w") as f:
+            json.dump({"dbc_sha256": dbc_hash, "messages": layouts}, f)
+        os.replace(f"{cache_file}.tmp", cache_file)
+    except OSError as e:
+        print(f"Warning: could not write frame encoder cache '{cache_file}': {e}")
+    return encoders
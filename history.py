@@ -0,0 +1,144 @@
+"""
+Fixed-memory history of numeric field values.
+
+Every field is recorded into a few tiers of preallocated ring buffers, each holding
+min/max/sum/count aggregates of fixed size buckets (e.g. 1 s buckets for 6 hours and
+60 s buckets for 2 weeks). The memory used is allocated up front and never grows.
+"""
+from array import array
+from itertools import compress
+from operator import truediv
+import math
+
+# Bytes per bucket: min and max ('f'), sum ('d') and sample count ('I')
+BUCKET_SIZE = 4 + 4 + 8 + 4
+
+def parse_tiers(spec: str):
+    """Parses comma separated 'resolution_seconds:buckets' entries, finest resolution first."""
+    tiers = []
+    for entry in filter(None, spec.replace(" ", "").split(",")):
+        resolution, size = entry.split(":")
+        tiers.append((int(resolution), int(size)))
+    return sorted(tiers)
+
+class Tier:
+    """Ring buffer of the last `size` buckets of `resolution` seconds each."""
+    def __init__(self, resolution: int, size: int):
+        self.resolution = resolution
+        self.size = size
+        # Empty buckets have a count of 0 and min/max of +inf/-inf, so that slices of
+        # them can be aggregated with the min(), max() and sum() builtins
+        self.mins = array("f", [math.inf]) * size
+        self.maxs = array("f", [-math.inf]) * size
+        self.sums = array("d", [0.0]) * size
+        self.counts = array("I", [0]) * size
+        # Index (timestamp // resolution) of the newest bucket
+        self.last = None
+
+    def oldest(self):
+        """Returns the start time of the oldest bucket kept, or None before the first sample."""
+        return None if self.last is None else (self.last - self.size + 1) * self.resolution
+
+    def clear(self, first: int, last: int):
+        """Empties the buckets with indices first..last."""
+        if last - first + 1 >= self.size:
+            first, last = 0, self.size - 1
+        else:
+            first, last = first % self.size, last % self.size
+        for start, end in ((first, last + 1),) if first <= last else ((first, self.size), (0, last + 1)):
+            self.mins[start:end] = array("f", [math.inf]) * (end - start)
+            self.maxs[start:end] = array("f", [-math.inf]) * (end - start)
+            self.sums[start:end] = array("d", [0.0]) * (end - start)
+            self.counts[start:end] = array("I", [0]) * (end - start)
+
+    def add(self, timestamp: float, value: float):
+        bucket = int(timestamp // self.resolution)
+        if self.last is None:
+            self.last = bucket
+        elif bucket > self.last:
+            self.clear(self.last + 1, bucket)
+            self.last = bucket
+        elif bucket <= self.last - self.size:
+            return  # Older than anything kept
+        slot = bucket % self.size
+        if value < self.mins[slot]: self.mins[slot] = value
+        if value > self.maxs[slot]: self.maxs[slot] = value
+        self.sums[slot] += value
+        self.counts[slot] += 1
+
+    def window(self, first: int, last: int):
+        """Returns the (mins, maxs, sums, counts) arrays of the buckets first..last, in time order."""
+        start, end = first % self.size, last % self.size + 1
+        if start < end:
+            return self.mins[start:end], self.maxs[start:end], self.sums[start:end], self.counts[start:end]
+        return (self.mins[start:] + self.mins[:end], self.maxs[start:] + self.maxs[:end],
+                self.sums[start:] + self.sums[:end], self.counts[start:] + self.counts[:end])
+
+    def query(self, start: float, end: float, step: int):
+        """
+        Returns {"timestamps", "min", "max", "mean", "count"} lists of the non-empty buckets
+        between start and end, merged into buckets of `step` tier buckets each.
+        """
+        result = {"timestamps": [], "min": [], "max": [], "mean": [], "count": []}
+        if self.last is None:
+            return result
+        first = max(int(start // self.resolution), self.last - self.size + 1)
+        last = min(int(end // self.resolution), self.last)
+        if first > last:
+            return result
+
+        # Align the merged buckets to multiples of their own size
+        first -= first % step
+        first = max(first, self.last - self.size + 1)
+        mins, maxs, sums, counts = self.window(first, last)
+        timestamps, out_min, out_max, out_mean, out_count = result.values()
+        if step == 1:
+            present = list(counts)
+            timestamps.extend(compress(range(first * self.resolution, (last + 1) * self.resolution, self.resolution), present))
+            out_min.extend(compress(mins, present))
+            out_max.extend(compress(maxs, present))
+            out_count.extend(compress(counts, present))
+            out_mean.extend(map(truediv, compress(sums, present), out_count))
+            return result
+
+        group_start = first
+        while group_start <= last:
+            group_end = min((group_start // step + 1) * step, last + 1)
+            a, b = group_start - first, group_end - first
+            count = sum(counts[a:b])
+            if count:
+                timestamps.append((group_start - group_start % step) * self.resolution)
+                out_min.append(min(mins[a:b]))
+                out_max.append(max(maxs[a:b]))
+                out_mean.append(sum(sums[a:b]) / count)
+                out_count.append(count)
+            group_start = group_end
+        return result
+
+class FieldHistory:
+    """The history of one field, recorded into every tier."""
+    def __init__(self, tiers):
+        self.tiers = [Tier(resolution, size) for resolution, size in tiers]
+
+    def add(self, timestamp: float, value: float):
+        for tier in self.tiers:
+            tier.add(timestamp, value)
+
+    def query(self, start: float, end: float, resolution: float | None = None):
+        """
+        Returns the buckets between start and end from the finest tier that still covers
+        start, merged to the requested resolution (in seconds) where it is coarser than
+        the tier's. The returned dict also has the actual 'resolution' of the buckets.
+        """
+        def covers(tier):
+            return tier.oldest() is not None and tier.oldest() <= start
+
+        tier = next((t for t in self.tiers if covers(t) and (resolution is None or t.resolution <= resolution)), None)
+        if tier is None:
+            tier = next((t for t in self.tiers if covers(t)), self.tiers[-1])
+        step = max(1, int(resolution // tier.resolution)) if resolution else 1
+        return {"resolution": tier.resolution * step, **tier.query(start, end, step)}
+
+def memory_size(tiers, field_count: int):
+    """Returns the bytes preallocated for recording field_count fields into the given tiers."""
+    return field_count * sum(size for resolution, size in tiers) * BUCKET_SIZE
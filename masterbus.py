@@ -0,0 +1,360 @@
+"""
+ctypes bindings for libmasterbus, shared by the API service and the bridge's in-process value source.
+"""
+from ctypes import *
+import os
+import threading
+import time
+
+import metrics
+
+class MasterBusError(Exception):
+    """Raised when a libmasterbus call fails."""
+
+# --- Type Definitions and Structures ---
+
+# Load the shared library
+LIBRARY_PATH = os.environ.get("MASTERBUS_LIBRARY", "/usr/local/lib/libmasterbus.so")
+try:
+    libmasterbus = CDLL(LIBRARY_PATH)
+except OSError as e:
+    print(f"Fatal: Could not load libmasterbus.so from {LIBRARY_PATH}.")
+    raise e
+
+class MasterBusAPIContext(Structure): pass
+class MasterBusValue(Structure): pass
+
+class MasterBusDate(Structure):
+    _fields_ = [("day", c_int), ("mon", c_int), ("year", c_int)]
+
+class MasterBusTime(Structure):
+    _fields_ = [("sec", c_int), ("min", c_int), ("hour", c_int), ("days", c_uint32)]
+
+MasterBusDeviceID = c_uint32
+MasterBusFieldID = c_int32
+MasterBusGroupID = c_int32
+ValueType = c_int
+
+# --- Function Prototypes (argtypes and restype) ---
+
+def setup_prototypes():
+    # Helper to avoid cluttering the global namespace
+    
+    # Connection
+    libmasterbus.masterbus_api_socketcan.argtypes = [c_char_p]
+    libmasterbus.masterbus_api_socketcan.restype = POINTER(MasterBusAPIContext)
+    
+    # Memory Management
+    libmasterbus.masterbus_free.argtypes = [POINTER(MasterBusAPIContext)]
+    libmasterbus.masterbus_free.restype = None
+    libmasterbus.masterbus_free_device_list.argtypes = [POINTER(MasterBusDeviceID), c_int]
+    libmasterbus.masterbus_free_field_list.argtypes = [POINTER(MasterBusFieldID), c_int]
+    libmasterbus.masterbus_free_str.argtypes = [c_char_p]
+    libmasterbus.masterbus_free_value.argtypes = [POINTER(MasterBusValue)]
+
+    # Device Info
+    libmasterbus.masterbus_devices.argtypes = [POINTER(MasterBusAPIContext), POINTER(POINTER(MasterBusDeviceID))]
+    libmasterbus.masterbus_devices.restype = c_int
+    libmasterbus.masterbus_device_name.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
+    libmasterbus.masterbus_device_name.restype = c_int
+    libmasterbus.masterbus_device_article_number.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
+    libmasterbus.masterbus_device_article_number.restype = c_int
+    libmasterbus.masterbus_device_serial_number.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
+    libmasterbus.masterbus_device_serial_number.restype = c_int
+    libmasterbus.masterbus_device_firmware_version.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
+    libmasterbus.masterbus_device_firmware_version.restype = c_int
+    libmasterbus.masterbus_device_extended_firmware_version.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, POINTER(c_char_p)]
+    libmasterbus.masterbus_device_extended_firmware_version.restype = c_int
+    libmasterbus.masterbus_device_status.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID]
+    libmasterbus.masterbus_device_status.restype = c_int
+
+    # Monitoring Groups & Fields
+    libmasterbus.masterbus_device_nr_of_monitoring_groups.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID]
+    libmasterbus.masterbus_device_nr_of_monitoring_groups.restype = c_int
+    libmasterbus.masterbus_monitoring_group_name.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusGroupID, POINTER(c_char_p)]
+    libmasterbus.masterbus_monitoring_group_name.restype = c_int
+    libmasterbus.masterbus_monitoring_group_fields.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusGroupID, POINTER(POINTER(MasterBusFieldID))]
+    libmasterbus.masterbus_monitoring_group_fields.restype = c_int
+    libmasterbus.masterbus_monitoring_field_name.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID, POINTER(c_char_p)]
+    libmasterbus.masterbus_monitoring_field_name.restype = c_int
+    libmasterbus.masterbus_monitoring_field_unit.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID, POINTER(c_char_p)]
+    libmasterbus.masterbus_monitoring_field_unit.restype = c_int
+    
+    # Value Reading
+    libmasterbus.masterbus_monitoring_field_value.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID]
+    libmasterbus.masterbus_monitoring_field_value.restype = POINTER(MasterBusValue)
+    libmasterbus.masterbus_value_type.argtypes = [POINTER(MasterBusValue)]
+    libmasterbus.masterbus_value_type.restype = ValueType
+    libmasterbus.masterbus_value_get_float.argtypes = [POINTER(MasterBusValue)]
+    libmasterbus.masterbus_value_get_float.restype = c_float
+    libmasterbus.masterbus_value_get_boolean.argtypes = [POINTER(MasterBusValue)]
+    libmasterbus.masterbus_value_get_boolean.restype = c_bool
+    libmasterbus.masterbus_value_get_date.argtypes = [POINTER(MasterBusValue)]
+    libmasterbus.masterbus_value_get_date.restype = MasterBusDate
+    libmasterbus.masterbus_value_get_time.argtypes = [POINTER(MasterBusValue)]
+    libmasterbus.masterbus_value_get_time.restype = MasterBusTime
+    libmasterbus.masterbus_value_get_string.argtypes = [POINTER(MasterBusValue), POINTER(c_char_p)]
+    libmasterbus.masterbus_value_get_string.restype = c_int
+    libmasterbus.masterbus_value_get_list_index.argtypes = [POINTER(MasterBusValue)]
+    libmasterbus.masterbus_value_get_list_index.restype = c_int
+    libmasterbus.masterbus_value_get_list_size.argtypes = [POINTER(MasterBusValue)]
+    libmasterbus.masterbus_value_get_list_size.restype = c_int
+    libmasterbus.masterbus_value_get_list_string.argtypes = [POINTER(MasterBusValue), c_int, POINTER(c_char_p)]
+    libmasterbus.masterbus_value_get_list_string.restype = c_int
+    libmasterbus.masterbus_value_get_list_device_id.argtypes = [POINTER(MasterBusValue), c_int]
+    libmasterbus.masterbus_value_get_list_device_id.restype = MasterBusDeviceID
+
+    # Value Writing
+    libmasterbus.masterbus_set_boolean.argtypes = [POINTER(MasterBusAPIContext), MasterBusDeviceID, MasterBusFieldID, c_bool]
+    libmasterbus.masterbus_set_boolean.restype = POINTER(MasterBusValue)
+
+setup_prototypes()
+
+# --- Instrumentation ---
+# With metrics enabled, the library functions that talk to the bus are replaced by wrappers
+# timing every call and counting failed ones (a negative result or a NULL pointer).
+
+CALL_SECONDS = metrics.Histogram("masterbus_call_seconds", "Duration of libmasterbus calls.", ["function"])
+CALL_ERRORS = metrics.Counter("masterbus_call_errors_total", "libmasterbus calls that returned an error.", ["function"])
+
+BUS_FUNCTIONS = [
+    "masterbus_api_socketcan", "masterbus_devices", "masterbus_device_name", "masterbus_device_article_number",
+    "masterbus_device_serial_number", "masterbus_device_firmware_version", "masterbus_device_extended_firmware_version",
+    "masterbus_device_status", "masterbus_device_nr_of_monitoring_groups", "masterbus_monitoring_group_name",
+    "masterbus_monitoring_group_fields", "masterbus_monitoring_field_name", "masterbus_monitoring_field_unit",
+    "masterbus_monitoring_field_value", "masterbus_set_boolean",
+]
+
+def instrument(name: str):
+    func = getattr(libmasterbus, name)
+    def call(*args):
+        start = time.perf_counter()
+        result = func(*args)
+        CALL_SECONDS.observe(time.perf_counter() - start, name)
+        if (result < 0) if isinstance(result, int) else not result:
+            CALL_ERRORS.inc(name)
+        return result
+    setattr(libmasterbus, name, call)
+
+if metrics.ENABLED:
+    for name in BUS_FUNCTIONS:
+        instrument(name)
+
+# --- Connection ---
+
+def connect_socketcan(port: str):
+    """Opens a MasterBus context on a SocketCAN port. Free it with libmasterbus.masterbus_free()."""
+    ctx = libmasterbus.masterbus_api_socketcan(port.encode('utf-8'))
+    if not ctx:
+        raise MasterBusError(f"Failed to connect to SocketCAN port '{port}'.")
+    return ctx
+
+# --- Value Decoding ---
+# Values are decoded through DECODERS, a table of per-type functions. The option texts of
+# LIST_OPTION and EVENTABLE fields are static, so they are fetched once per (device, field)
+# and later reads of these fields only ask the library for the selected index.
+
+VALUE_TYPE_FLOAT = 0
+VALUE_TYPE_DATE = 1
+VALUE_TYPE_TIME = 2
+VALUE_TYPE_BOOLEAN = 3
+VALUE_TYPE_LIST_OPTION = 4
+VALUE_TYPE_TEXT = 5
+VALUE_TYPE_DEVICE_ID = 6
+VALUE_TYPE_EVENTABLE = 7
+
+# {(device_id, field_id): [{"index": i, "text": ...}, ...]} of LIST_OPTION and EVENTABLE fields
+option_cache = {}
+
+# Per-thread c_char_p reused as the out-parameter of the string getters
+scratch = threading.local()
+
+def clear_option_cache(device_ids=None):
+    """Forgets the cached option texts of the given devices, or of all devices."""
+    if device_ids is None:
+        option_cache.clear()
+        return
+    device_ids = set(device_ids)
+    # Copied first, as the bus threads may add entries meanwhile; list() takes the keys under the GIL
+    for key in list(option_cache):
+        if key[0] in device_ids:
+            option_cache.pop(key, None)
+
+def string_out():
+    """Returns this thread's scratch c_char_p, reset to NULL."""
+    str_ptr = getattr(scratch, "str_ptr", None)
+    if str_ptr is None:
+        str_ptr = scratch.str_ptr = c_char_p()
+    else:
+        str_ptr.value = None
+    return str_ptr
+
+def take_string(str_ptr):
+    """Decodes the string the library returned in str_ptr and frees it."""
+    raw = str_ptr.value
+    if raw is None:
+        return None
+    libmasterbus.masterbus_free_str(str_ptr)
+    return raw.decode('utf-8', 'ignore')
+
+def decode_float(value_ptr, device_id, field_id):
+    return get_float(value_ptr)
+
+def decode_date(value_ptr, device_id, field_id):
+    date_val = get_date(value_ptr)
+    return f"{date_val.year:04d}-{date_val.mon:02d}-{date_val.day:02d}"
+
+def decode_time(value_ptr, device_id, field_id):
+    time_val = get_time(value_ptr)
+    return f"{time_val.days}d {time_val.hour:02d}:{time_val.min:02d}:{time_val.sec:02d}"
+
+def decode_boolean(value_ptr, device_id, field_id):
+    return get_boolean(value_ptr)
+
+def decode_options(value_ptr, device_id, field_id):
+    index = get_list_index(value_ptr)
+    options = option_cache.get((device_id, field_id))
+    if options is None:
+        options = []
+        for i in range(get_list_size(value_ptr)):
+            str_ptr = string_out()
+            get_list_string(value_ptr, i, str_ptr)
+            options.append({"index": i, "text": take_string(str_ptr)})
+        option_cache[(device_id, field_id)] = options
+    return {"selectedIndex": index, "options": options}
+
+def decode_text(value_ptr, device_id, field_id):
+    str_ptr = string_out()
+    get_string(value_ptr, str_ptr)
+    return take_string(str_ptr)
+
+def decode_device_ids(value_ptr, device_id, field_id):
+    # Not cached, as the devices in the list can change
+    index = get_list_index(value_ptr)
+    options = [{"index": i, "device_id": get_list_device_id(value_ptr, i)} for i in range(get_list_size(value_ptr))]
+    return {"selectedIndex": index, "options": options}
+
+DECODERS = {
+    VALUE_TYPE_FLOAT: decode_float,
+    VALUE_TYPE_DATE: decode_date,
+    VALUE_TYPE_TIME: decode_time,
+    VALUE_TYPE_BOOLEAN: decode_boolean,
+    VALUE_TYPE_LIST_OPTION: decode_options,
+    VALUE_TYPE_TEXT: decode_text,
+    VALUE_TYPE_DEVICE_ID: decode_device_ids,
+    VALUE_TYPE_EVENTABLE: decode_options,
+}
+
+# Library functions bound once, so decoding doesn't look them up on every call
+get_type = libmasterbus.masterbus_value_type
+get_float = libmasterbus.masterbus_value_get_float
+get_date = libmasterbus.masterbus_value_get_date
+get_time = libmasterbus.masterbus_value_get_time
+get_boolean = libmasterbus.masterbus_value_get_boolean
+get_string = libmasterbus.masterbus_value_get_string
+get_list_index = libmasterbus.masterbus_value_get_list_index
+get_list_size = libmasterbus.masterbus_value_get_list_size
+get_list_string = libmasterbus.masterbus_value_get_list_string
+get_list_device_id = libmasterbus.masterbus_value_get_list_device_id
+free_value = libmasterbus.masterbus_free_value
+
+def process_value(value_ptr: POINTER(MasterBusValue), device_id: int, field_id: int):
+    """Helper function to convert a MasterBusValue pointer to a JSON-serializable dict, freeing the value."""
+    if not value_ptr:
+        raise MasterBusError("Failed to get or set value from MasterBus.")
+
+    try:
+        v_type = get_type(value_ptr)
+        decode = DECODERS.get(v_type)
+        value = decode(value_ptr, device_id, field_id) if decode else "Unsupported or invalid value type"
+    finally:
+        free_value(value_ptr)
+
+    return {"device_id": device_id, "field_id": field_id, "value_type": v_type, "value": value}
+
+# --- MasterBus Access ---
+# Blocking helpers calling into libmasterbus. A context must not be used by several threads
+# at once, so callers sharing one context are expected to serialize these calls.
+
+def get_string_from_library(ctx, func, device_id: int, a_name: str):
+    """Helper for funcs that return a string."""
+    str_ptr = c_char_p()
+    result = func(ctx, device_id, byref(str_ptr))
+    if result < 0: raise MasterBusError(f"Failed to get {a_name} (err: {result})")
+    try:
+        return str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else None
+    finally:
+        libmasterbus.masterbus_free_str(str_ptr)
+
+def get_field_string_from_library(ctx, func, device_id: int, field_id: int, a_name: str):
+    """Helper for funcs that return a string for a monitoring field."""
+    str_ptr = c_char_p()
+    result = func(ctx, device_id, field_id, byref(str_ptr))
+    if result < 0: raise MasterBusError(f"Failed to get {a_name} (err: {result})")
+    try:
+        return str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else None
+    finally:
+        libmasterbus.masterbus_free_str(str_ptr)
+
+def read_devices(ctx):
+    devices_ptr = POINTER(MasterBusDeviceID)()
+    count = libmasterbus.masterbus_devices(ctx, byref(devices_ptr))
+    if count < 0: raise MasterBusError(f"Failed to get devices (err: {count})")
+    try:
+        return [devices_ptr[i] for i in range(count)]
+    finally:
+        libmasterbus.masterbus_free_device_list(devices_ptr, count)
+
+def read_device_status(ctx, device_id: int):
+    status = libmasterbus.masterbus_device_status(ctx, device_id)
+    if status < 0: raise MasterBusError(f"Failed to get status (err: {status})")
+    return status
+
+def read_monitoring_groups(ctx, device_id: int):
+    count = libmasterbus.masterbus_device_nr_of_monitoring_groups(ctx, device_id)
+    if count < 0: raise MasterBusError(f"Failed to get group count (err: {count})")
+    groups = []
+    for i in range(count):
+        str_ptr = c_char_p()
+        libmasterbus.masterbus_monitoring_group_name(ctx, device_id, i, byref(str_ptr))
+        groups.append({"group_id": i, "name": str_ptr.value.decode('utf-8', 'ignore') if str_ptr.value else f"Group {i}"})
+        libmasterbus.masterbus_free_str(str_ptr)
+    return groups
+
+def read_monitoring_group_fields(ctx, device_id: int, group_id: int):
+    fields_ptr = POINTER(MasterBusFieldID)()
+    count = libmasterbus.masterbus_monitoring_group_fields(ctx, device_id, group_id, byref(fields_ptr))
+    if count < 0: raise MasterBusError(f"Failed to get fields (err: {count})")
+    try:
+        return [fields_ptr[i] for i in range(count)]
+    finally:
+        libmasterbus.masterbus_free_field_list(fields_ptr, count)
+
+def read_field_value(ctx, device_id: int, field_id: int):
+    value_ptr = libmasterbus.masterbus_monitoring_field_value(ctx, device_id, field_id)
+    return process_value(value_ptr, device_id, field_id)
+
+def write_boolean(ctx, device_id: int, field_id: int, value: bool):
+    value_ptr = libmasterbus.masterbus_set_boolean(ctx, device_id, field_id, value)
+    return process_value(value_ptr, device_id, field_id)
+
+def read_catalog_device(ctx, device_id: int):
+    """Walks the monitoring groups and fields of one device to build its catalog entry."""
+    groups = []
+    for group in read_monitoring_groups(ctx, device_id):
+        fields = []
+        for field_id in read_monitoring_group_fields(ctx, device_id, group["group_id"]):
+            fields.append({
+                "field_id": field_id,
+                "name": get_field_string_from_library(ctx, libmasterbus.masterbus_monitoring_field_name, device_id, field_id, "field name"),
+                "unit": get_field_string_from_library(ctx, libmasterbus.masterbus_monitoring_field_unit, device_id, field_id, "field unit"),
+            })
+        groups.append({**group, "fields": fields})
+    return {
+        "device_id": device_id,
+        "name": get_string_from_library(ctx, libmasterbus.masterbus_device_name, device_id, "name"),
+        "article_number": get_string_from_library(ctx, libmasterbus.masterbus_device_article_number, device_id, "article number"),
+        "serial_number": get_string_from_library(ctx, libmasterbus.masterbus_device_serial_number, device_id, "serial number"),
+        "monitoring_groups": groups,
+    }
+
@@ -0,0 +1,128 @@
+"""
+Minimal Prometheus-style metrics, shared by the API service and the bridge.
+
+Metrics register themselves on creation and are rendered in the Prometheus text format
+by render(). With METRICS_ENABLED=0 updating a metric returns right away, and callers
+skip any instrumentation that would cost more than that check.
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import os
+import threading
+
+ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+
+# Upper bounds (seconds) of the histogram buckets, from sub-millisecond bus calls to slow API fetches
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = []
+
+class Metric:
+    """Base class of the metric types; values are kept per tuple of label values."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        """Yields (name suffix, label names, label values, value) tuples."""
+        with self.lock:
+            items = list(self.values.items())
+        for label_values, value in items:
+            yield "", self.labels, label_values, value
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        if not ENABLED: return
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        if not ENABLED: return
+        with self.lock:
+            self.values[label_values] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        if not ENABLED: return
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(label_values, list(counts), total) for label_values, (counts, total) in self.values.items()]
+        names = self.labels + ("le",)
+        for label_values, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", names, label_values + (format_value(bound),), cumulative
+            yield "_sum", self.labels, label_values, total
+            yield "_count", self.labels, label_values, cumulative
+
+def format_value(value):
+    if value == math.inf: return "+Inf"
+    if value == -math.inf: return "-Inf"
+    if value != value: return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+def render():
+    """Returns every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, names, values, value in metric.samples():
+            lines.append(f"{metric.name}{suffix}{format_labels(names, values)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port: int, host: str = ""):
+    """Serves /metrics over HTTP from a background thread, for processes without a web framework."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
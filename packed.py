@@ -0,0 +1,40 @@
+"""
+Packed binary encoding of numeric field values, served by the API's /values/packed endpoint
+and read by the bridge. All little-endian:
+
+    header  magic b"MBPV", version (u16), value count n (u16), timestamp (f64)
+    fields  n x (device_id u32, field_id i32), in request order, each field once
+    values  n x f32, NaN for values that could not be read or are not numeric
+
+The timestamp is the read time of the oldest value, NaN if none was read. For a fixed list
+of fields everything but the timestamp and the values is always the same, so a response
+unpacks with one struct.unpack.
+"""
+import struct
+
+MAGIC = b"MBPV"
+VERSION = 1
+MEDIA_TYPE = "application/octet-stream"
+# IDs that fit the u32 device_id and i32 field_id of the fields list
+DEVICE_IDS = range(1 << 32)
+FIELD_IDS = range(-(1 << 31), 1 << 31)
+
+class PackedValues:
+    """Packs and unpacks the values of a fixed list of (device_id, field_id) fields."""
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.ids = tuple(part for field in self.fields for part in field)
+        self.struct = struct.Struct(f"<4sHHd{'Ii' * len(self.fields)}{len(self.fields)}f")
+
+    def pack(self, timestamp: float, values):
+        return self.struct.pack(MAGIC, VERSION, len(self.fields), timestamp, *self.ids, *values)
+
+    def unpack(self, data: bytes):
+        """Returns the timestamp and the values, raising ValueError if data isn't for these fields."""
+        if len(data) != self.struct.size:
+            raise ValueError(f"Expected {self.struct.size} bytes of packed values, got {len(data)}")
+        items = self.struct.unpack(data)
+        count = len(self.fields)
+        if items[:3] != (MAGIC, VERSION, count) or items[4:4 + 2 * count] != self.ids:
+            raise ValueError("Packed values are not for the requested fields")
+        return items[3], items[4 + 2 * count:]
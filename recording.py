@@ -0,0 +1,205 @@
+"""
+Compact binary log of what the bridge read and what it sent, for replaying it later.
+
+A log file is a 24 byte header followed by 26 byte records, each starting with a
+time.monotonic() timestamp:
+    TICK     a bridge tick started, with the alive counter's next deadline; followed by the
+             VALUE/MISSING records of its values
+    VALUE    device_id, field_id and the value read
+    MISSING  device_id and field_id of a value that was not available
+    FRAME    arbitration ID and payload handed to a periodic CAN task
+    STATE    arbitration ID and payload a periodic CAN task was already sending when a
+             rotated file was started, so that every file can be replayed on its own
+The header holds the offset from the monotonic timestamps to wall clock time, which they are
+converted with when read so that files of different runs line up, and whether the file
+continues the run of the file rotated before it.
+
+    python recording.py bridge.mbr   # prints a log as text
+"""
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"MBRLOG\x00\x02"
+
+# Header: magic, wall clock time minus monotonic time when the file was started, and whether
+# the file continues a run rather than starting one
+HEADER = struct.Struct("<8sd?7x")
+
+# Record: timestamp, kind, frame length, field ID, device or arbitration ID, then the value,
+# payload or alive deadline
+RECORD = struct.Struct("<dBBiI8s")
+VALUE = struct.Struct("<d")
+
+TICK, VALUE_RECORD, MISSING, FRAME, STATE = 0, 1, 2, 3, 4
+
+class ReplayFinished(Exception):
+    """Raised by a replaying value source after the last recorded tick."""
+
+class Recorder:
+    """
+    Appends ticks and frames to a log file. Every run starts a new file; once a file reaches
+    max_bytes it is rotated like a log file, keeping `keep` older files as path.1 (newest) to path.N.
+    """
+    def __init__(self, path: str, max_bytes: int = 16 * 1024 * 1024, keep: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.file = None
+        # The payload of every CAN task, written again at the start of each rotated file
+        self.sending = {}
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.rotate_files()
+        self.open(continued=False)
+
+    def open(self, continued: bool):
+        self.file = open(self.path, "wb")
+        self.file.write(HEADER.pack(MAGIC, time.time() - time.monotonic(), continued))
+        now = time.monotonic()
+        self.file.write(b"".join(RECORD.pack(now, STATE, len(data), 0, frame_id, data) for frame_id, data in self.sending.items()))
+
+    def rotate_files(self):
+        for index in range(self.keep - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.keep > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def tick(self, timestamp: float, values: dict, alive_deadline: float = math.nan):
+        """
+        Records the start of a tick with the {(device_id, field_id): value} dict it read and the
+        monotonic time the alive counter is next due.
+        """
+        records = [RECORD.pack(timestamp, TICK, 0, 0, 0, VALUE.pack(alive_deadline))]
+        for (device_id, field_id), value in values.items():
+            if isinstance(value, (int, float)):
+                records.append(RECORD.pack(timestamp, VALUE_RECORD, 0, field_id, device_id, VALUE.pack(value)))
+            else:
+                records.append(RECORD.pack(timestamp, MISSING, 0, field_id, device_id, b""))
+        self.file.write(b"".join(records))
+
+    def frame(self, frame_id: int, data: bytes):
+        """Records a payload handed to a periodic CAN task."""
+        self.sending[frame_id] = bytes(data)
+        self.file.write(RECORD.pack(time.monotonic(), FRAME, len(data), 0, frame_id, bytes(data)))
+
+    def flush(self):
+        """Writes out the buffered records, rotating the file once it is large enough."""
+        self.file.flush()
+        if self.file.tell() >= self.max_bytes:
+            self.file.close()
+            self.rotate_files()
+            self.open(continued=True)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def log_files(path: str):
+    """Returns a log and its rotated files that exist, oldest first."""
+    rotated = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        rotated.append(f"{path}.{index}")
+        index += 1
+    return rotated[::-1] + ([path] if os.path.exists(path) else [])
+
+def read_header(path: str):
+    """Returns the clock offset of a log file and whether it continues a run, None for an empty file."""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    magic, clock_offset, continued = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"'{path}' is not a bridge recording of this version")
+    return clock_offset, continued
+
+def read_records(path: str):
+    """
+    Yields the (timestamp, kind, length, field_id, id, payload) records of a log file, read
+    through mmap, with their monotonic timestamps as recorded.
+    """
+    if read_header(path) is None:
+        return
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # A record cut short by a crash is left out
+            end = HEADER.size + (len(mapped) - HEADER.size) // RECORD.size * RECORD.size
+            view = memoryview(mapped)[HEADER.size:end]
+            try:
+                yield from RECORD.iter_unpack(view)
+            finally:
+                view.release()
+
+def read_ticks(paths):
+    """
+    Yields (timestamp, values, frames, alive_deadline, sending) for every tick in the given log
+    files, with wall clock times: the {(device_id, field_id): value} dict read, the
+    (frame_id, payload) list sent and when the alive counter was next due (None if unknown).
+    `sending` is None, except on the first tick replayed of a run: there it is the
+    {frame_id: payload} dict the CAN tasks were already sending, empty at the start of a run.
+    """
+    tick = None
+    sending = None
+    first = True
+    unpack_value = VALUE.unpack
+    for path in paths:
+        header = read_header(path)
+        if header is None:
+            continue
+        clock_offset, continued = header
+        # The first file may start in the middle of a run, later ones only continue it or start another
+        if first or not continued:
+            sending = {}
+        first = False
+        for record_time, kind, length, field_id, record_id, payload in read_records(path):
+            if kind == TICK:
+                if tick is not None:
+                    yield tick
+                alive_deadline = unpack_value(payload)[0] + clock_offset
+                tick = (record_time + clock_offset, {}, [], None if math.isnan(alive_deadline) else alive_deadline, sending)
+                sending = None
+            elif kind == STATE:
+                if sending is not None:
+                    sending[record_id] = payload[:length]
+            elif tick is None:
+                continue  # Records before the first tick
+            elif kind == VALUE_RECORD:
+                tick[1][(record_id, field_id)] = unpack_value(payload)[0]
+            elif kind == MISSING:
+                tick[1][(record_id, field_id)] = None
+            elif kind == FRAME:
+                tick[2].append((record_id, payload[:length]))
+    if tick is not None:
+        yield tick
+
+def dump(path: str):
+    """Prints a log file as text, one record per line, with wall clock timestamps."""
+    header = read_header(path)
+    if header is None:
+        return
+    clock_offset, continued = header
+    print(f"{path}: {'continues a run' if continued else 'starts a run'}")
+    for timestamp, kind, length, field_id, record_id, payload in read_records(path):
+        timestamp += clock_offset
+        if kind == TICK:
+            print(f"{timestamp:.6f} TICK alive due {VALUE.unpack(payload)[0] + clock_offset:.6f}")
+        elif kind == VALUE_RECORD:
+            print(f"{timestamp:.6f} VALUE {record_id}:{field_id} = {VALUE.unpack(payload)[0]}")
+        elif kind == MISSING:
+            print(f"{timestamp:.6f} VALUE {record_id}:{field_id} missing")
+        elif kind == FRAME:
+            print(f"{timestamp:.6f} FRAME {record_id} {payload[:length].hex()}")
+        elif kind == STATE:
+            print(f"{timestamp:.6f} STATE {record_id} {payload[:length].hex()}")
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        dump(path)
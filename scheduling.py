@@ -0,0 +1,14 @@
+"""
+Fixed-grid deadlines, shared by the API's poller and the bridge's schedules.
+"""
+import math
+
+def next_deadline(deadline, interval, now):
+    """
+    The deadline following `deadline` on its fixed grid of `interval` seconds. Deadlines already
+    missed at `now` are skipped rather than run back to back, and lateness never shifts the grid.
+    """
+    deadline += interval
+    if deadline <= now:
+        deadline += (math.floor((now - deadline) / interval) + 1) * interval
+    return deadline
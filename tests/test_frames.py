@@ -0,0 +1,78 @@
+"""Checks the precompiled frame encoders against cantools. Run with: python -m pytest tests"""
+import os
+import random
+
+import cantools
+import pytest
+
+import frames
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DBC_FILE = os.path.join(REPO_DIR, "pylon_CAN_210124.dbc")
+
+# Randomized inputs per message compared with cantools
+SAMPLES = 500
+
+def random_signal_value(signal):
+    """Returns a random value for a signal, within both its DBC range and its raw bit range."""
+    name, start, length, is_signed, scale, offset, minimum, maximum = signal
+    raw_low, raw_high = (-(1 << (length - 1)), (1 << (length - 1)) - 1) if is_signed else (0, (1 << length) - 1)
+    low, high = sorted((raw_low * scale + offset, raw_high * scale + offset))
+    if minimum is not None: low = max(low, minimum)
+    if maximum is not None: high = min(high, maximum)
+    return random.uniform(low, high)
+
+def encode_or_none(encode, data):
+    try:
+        return encode(data)
+    except Exception:
+        return None
+
+@pytest.fixture(scope="module")
+def db():
+    return cantools.database.load_file(DBC_FILE)
+
+@pytest.fixture(scope="module")
+def encoders(db):
+    layouts = frames.compile_layouts(db)
+    return {name: frames.FrameEncoder(name, **layout) for name, layout in layouts.items()}
+
+def test_encoders_match_cantools(db, encoders):
+    random.seed(0)
+    for name, encoder in encoders.items():
+        message = db.get_message_by_name(name)
+        for _ in range(SAMPLES):
+            data = {signal[0]: random_signal_value(signal) for signal in encoder.signals}
+            assert encode_or_none(encoder.encode, data) == encode_or_none(message.encode, data), (name, data)
+
+def test_out_of_range_values_raise_value_error(db, encoders):
+    for name, encoder in encoders.items():
+        data = {signal[0]: signal[7] + 10 * abs(signal[4]) if signal[7] is not None else 0 for signal in encoder.signals}
+        if any(signal[7] is not None for signal in encoder.signals):
+            with pytest.raises(ValueError):
+                encoder.encode(data)
+
+@pytest.mark.parametrize("start", [0, 4])  # Byte aligned (struct) and bit shifted signals
+def test_raw_overflow_raises_value_error(start):
+    encoder = frames.FrameEncoder("Test", 1, 4, [["Value", start, 16, False, 1, 0, None, None]])
+    assert encoder.encode({"Value": 65535})
+    with pytest.raises(ValueError):
+        encoder.encode({"Value": 65536})
+
+def test_cache_round_trip(tmp_path):
+    cache_file = str(tmp_path / "frames.json")
+    compiled = frames.load_encoders(DBC_FILE, cache_file)
+    assert os.listdir(tmp_path) == ["frames.json"]
+    cached = frames.load_encoders(DBC_FILE, cache_file)
+    data = {signal[0]: 0 for signal in compiled["Battery_actual_values_UIt"].signals}
+    assert cached.keys() == compiled.keys()
+    assert cached["Battery_actual_values_UIt"].encode(data) == compiled["Battery_actual_values_UIt"].encode(data)
+
+def test_decode_reverses_encode(encoders):
+    random.seed(1)
+    for name, encoder in encoders.items():
+        for _ in range(SAMPLES):
+            data = {signal[0]: random_signal_value(signal) for signal in encoder.signals}
+            decoded = encoder.decode(encoder.encode(data))
+            for signal in encoder.signals:
+                assert abs(decoded[signal[0]] - data[signal[0]]) <= abs(signal[4]) / 2 + 1e-9, (name, signal[0])